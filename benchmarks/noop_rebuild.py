@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+"""Time a kiwix-build run on an already built working directory.
+
+Nothing has changed, so all the steps should be skipped (or be a no-op
+ninja run) and the run should take about a second. The sources are checked
+as in a real run (a `git ls-remote` for each git repository), unless
+--offline is given.
+"""
+
+import os
+import sys
+import argparse
+import subprocess
+import time
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+KIWIX_BUILD = os.path.join(SCRIPT_DIR, '..', 'kiwix-build.py')
+
+
+def run_build(options, skip_source_prepare=False):
+    command = [sys.executable, KIWIX_BUILD, options.target,
+               '--working-dir', options.working_dir,
+               '--target-platform', options.target_platform]
+    if skip_source_prepare:
+        command.append('--skip-source-prepare')
+    start = time.monotonic()
+    subprocess.check_call(command, stdout=subprocess.DEVNULL)
+    return time.monotonic() - start
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('target', default='kiwix-tools', nargs='?')
+    parser.add_argument('--working-dir', default=".")
+    parser.add_argument('--target-platform', default="native_dyn")
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--offline', action='store_true',
+                        help=("Time the no-op runs with --skip-source-prepare"
+                              " (no network access)."))
+    parser.add_argument('--max-time', type=float, default=1.5,
+                        help="Fail if the median no-op run takes longer (in seconds).")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    options = parse_args()
+    options.working_dir = os.path.abspath(options.working_dir)
+    # Builds what is missing (everything in a new working dir).
+    print("First run of {} in {}".format(options.target, options.working_dir))
+    print("  {:.2f}s".format(run_build(options)))
+    times = sorted(run_build(options, options.offline) for _ in range(options.runs))
+    median = times[len(times)//2]
+    print("No-op rebuild ({} runs): min {:.2f}s, median {:.2f}s, max {:.2f}s".format(
+        options.runs, times[0], median, times[-1]))
+    if median > options.max_time:
+        sys.exit("ERROR: no-op rebuild is slower than {:.2f}s".format(options.max_time))
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+
+"""Benchmark the orchestration overhead of kiwix-build.py.
+
+Synthetic dependencies (registered as any other Dependency) are built from
+local stub tarballs and file:// git repositories, with fake configure, make,
+meson and ninja scripts which only sleep or burn some cpu. Nothing is
+downloaded from the network.
+
+The graph resolution, the environment building, extraction, hashing, the
+scheduler and full builds (first build, no-op rebuild and plan) are timed
+for wide, deep and diamond shaped graphs.
+"""
+
+import os
+import sys
+import io
+import argparse
+import contextlib
+import importlib.util
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import time
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+ROOT_DIR = os.path.dirname(SCRIPT_DIR)
+sys.path.insert(0, ROOT_DIR)
+
+from dependency_utils import Dependency, ReleaseDownload, GitClone, MakeBuilder, MesonBuilder
+from utils import (
+    pj,
+    Remotefile,
+    Scheduler,
+    DependencyGraph,
+    extract_archive,
+    get_sha256)
+
+
+def load_kiwix_build():
+    spec = importlib.util.spec_from_file_location('kiwix_build', pj(ROOT_DIR, 'kiwix-build.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+kiwix_build = load_kiwix_build()
+
+
+# The fake tools. Each "compilation" sleeps KB_BENCH_SLEEP seconds and loops
+# KB_BENCH_CPU times.
+WORK = """
+i=0
+while [ $i -lt ${KB_BENCH_CPU:-0} ]; do i=$((i+1)); done
+sleep ${KB_BENCH_SLEEP:-0}
+"""
+
+FAKE_TOOLS = {
+    'make': "#!/bin/sh\n" + WORK,
+    'meson': """#!/bin/sh
+if [ "$1" = "--version" ]; then echo 0.50.0; exit 0; fi
+mkdir -p "$2/meson-private"
+touch "$2/meson-private/coredata.dat" "$2/build.ninja"
+""" + WORK,
+    'ninja': """#!/bin/sh
+case "$1" in
+  --version) echo 1.10.0; exit 0;;
+  -n) if [ -f .built ]; then echo "ninja: no work to do."; else echo "[1/1] cc"; fi; exit 0;;
+esac
+""" + WORK + "touch .built\n",
+}
+
+CONFIGURE = "#!/bin/sh\n" + WORK
+
+
+def write_script(path, content):
+    with open(path, 'w') as f:
+        f.write(content)
+    os.chmod(path, 0o755)
+
+
+def make_tarball(path, top_dir, files=1):
+    src = tempfile.mkdtemp()
+    os.makedirs(pj(src, top_dir))
+    write_script(pj(src, top_dir, 'configure'), CONFIGURE)
+    for i in range(files):
+        with open(pj(src, top_dir, 'file{}.c'.format(i)), 'w') as f:
+            f.write("int f{}(void) {{ return {}; }}\n".format(i, i) * 10)
+    with tarfile.open(path, 'w:gz') as archive:
+        archive.add(pj(src, top_dir), arcname=top_dir)
+    shutil.rmtree(src)
+    return get_sha256(path)
+
+
+def make_git_repository(path):
+    os.makedirs(path)
+    with open(pj(path, 'meson.build'), 'w') as f:
+        f.write("project('bench', 'c')\n")
+    env = dict(os.environ, GIT_AUTHOR_NAME='bench', GIT_AUTHOR_EMAIL='bench@localhost',
+               GIT_COMMITTER_NAME='bench', GIT_COMMITTER_EMAIL='bench@localhost')
+    for command in (['git', 'init', '-q'],
+                    ['git', 'add', 'meson.build'],
+                    ['git', 'commit', '-q', '-m', 'init']):
+        subprocess.check_call(command, cwd=path, env=env)
+
+
+# Graph shapes: the dependencies of each node, by index. The last node is the root.
+def wide_graph(size):
+    return [[] for _ in range(size - 1)] + [list(range(size - 1))]
+
+
+def deep_graph(size):
+    return [[i - 1] if i else [] for i in range(size)]
+
+
+def diamond_graph(size):
+    # Layers of 3 nodes, each node depending on all the nodes of the layer
+    # below, and the root depending on the last layer.
+    graph = [list(range((i // 3 - 1) * 3, i // 3 * 3)) if i >= 3 else []
+             for i in range(size - 1)]
+    last_layer = (size - 2) // 3
+    return graph + [list(range(last_layer * 3, size - 1))]
+
+
+GRAPHS = {'wide': wide_graph, 'deep': deep_graph, 'diamond': diamond_graph}
+
+
+def register_dependencies(shape, graph, data_dir):
+    """Create a Dependency for each node. One node out of three comes from a
+       git repository and is built with meson, the others from a tarball."""
+    names = ["bench-{}-{}".format(shape, i) for i in range(len(graph))]
+    for i, (name, deps) in enumerate(zip(names, graph)):
+        if i % 3 == 2:
+            repository = pj(data_dir, name + '.git')
+            make_git_repository(repository)
+            source = type('Source', (GitClone,), {'git_remote': 'file://' + repository,
+                                                  'git_dir': name})
+            builder = MesonBuilder
+        else:
+            archive = pj(data_dir, name + '.tar.gz')
+            sha256 = make_tarball(archive, name + '-1.0')
+            source = type('Source', (ReleaseDownload,),
+                          {'archive': Remotefile(name + '.tar.gz', sha256, 'file://' + archive)})
+            builder = MakeBuilder
+        type(name, (Dependency,), {'name': name,
+                                   'version': None if i % 3 == 2 else '1.0',
+                                   'dependencies': [names[d] for d in deps],
+                                   'Source': source,
+                                   'Builder': builder})
+    return names[-1]
+
+
+def build_options(root, working_dir, extra_args=()):
+    argv = sys.argv
+    sys.argv = ['kiwix-build.py', root, '--working-dir', working_dir,
+                '--libprefix', 'lib', '--compiler-launcher', 'none',
+                '--download-segments', '1'] + list(extra_args)
+    try:
+        return kiwix_build.parse_args()
+    finally:
+        sys.argv = argv
+
+
+def timeit(function, repeat=1):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = function()
+    return (time.perf_counter() - start) / repeat, result
+
+
+def quiet(function):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return function()
+
+
+class Report:
+    def __init__(self):
+        self.results = []
+
+    def add(self, name, duration, unit_count=1, unit=""):
+        self.results.append((name, duration, unit_count, unit))
+        per_unit = ""
+        if unit:
+            per_unit = "{:>10.1f}µs/{}".format(duration / unit_count * 1000000, unit)
+        print("  {:<45} {:>10.4f}s {}".format(name, duration, per_unit))
+
+
+def bench_micro(report, data_dir, options):
+    print("[MICRO]")
+    archive = pj(data_dir, 'extract-bench.tar.gz')
+    make_tarball(archive, 'extract-bench', files=options.files)
+    dest = pj(data_dir, 'extract')
+    def extract():
+        if os.path.exists(dest):
+            shutil.rmtree(dest)
+        os.makedirs(dest)
+        extract_archive(archive, dest)
+    duration, _ = timeit(extract, options.repeat)
+    report.add("extract ({} files)".format(options.files), duration, options.files, "file")
+
+    big_file = pj(data_dir, 'hash-bench')
+    with open(big_file, 'wb') as f:
+        f.write(os.urandom(1024 * 1024) * options.hash_size)
+    duration, _ = timeit(lambda: get_sha256(big_file), options.repeat)
+    report.add("sha256 ({}MB)".format(options.hash_size), duration, options.hash_size, "MB")
+
+
+def bench_graph(report, shape, data_dir, work_dir, options):
+    print("[{} GRAPH, {} dependencies]".format(shape.upper(), options.size))
+    graph = GRAPHS[shape](options.size)
+    root = register_dependencies(shape, graph, data_dir)
+    build_options_ = build_options(root, work_dir, ['--jobs-deps', str(options.jobs_deps)])
+
+    duration, builder = timeit(lambda: kiwix_build.Builder(build_options_))
+    report.add("resolve graph", duration)
+    platformBuilder = builder.platformBuilders[0]
+    dependency_graph = platformBuilder.dependency_graph()
+    duration, _ = timeit(lambda: DependencyGraph(dependency_graph.dependencies).topological_order(),
+                         options.repeat)
+    report.add("topological sort", duration, options.size, "dep")
+
+    buildEnv = platformBuilder.buildEnv
+    count = options.repeat * 100
+    duration, _ = timeit(lambda: buildEnv._set_env(None, True, True), count)
+    report.add("BuildEnv._set_env", duration, 1, "call")
+
+    def schedule():
+        scheduler = Scheduler(options.jobs_deps)
+        for node, deps in dependency_graph.dependencies.items():
+            scheduler.add_task(node, lambda: None, deps)
+        scheduler.run()
+    duration, _ = timeit(schedule, options.repeat)
+    report.add("schedule no-op tasks", duration, options.size, "task")
+
+    duration, _ = timeit(lambda: quiet(builder.run))
+    report.add("first build", duration, options.size, "dep")
+    duration, _ = timeit(lambda: quiet(kiwix_build.Builder(build_options_).run), options.repeat)
+    report.add("no-op rebuild", duration, options.size, "dep")
+    duration, _ = timeit(lambda: quiet(kiwix_build.Builder(build_options_).plan), options.repeat)
+    report.add("plan", duration, options.size, "dep")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--graphs', nargs='+', choices=GRAPHS.keys(), default=list(GRAPHS),
+                        help="Shapes of the dependency graphs to benchmark.")
+    parser.add_argument('--size', type=int, default=20,
+                        help="Number of dependencies in each graph.")
+    parser.add_argument('--jobs-deps', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--files', type=int, default=1000,
+                        help="Number of files in the archive to extract.")
+    parser.add_argument('--hash-size', type=int, default=64, metavar='MB')
+    parser.add_argument('--sleep', type=float, default=0,
+                        help="Seconds each fake tool sleeps.")
+    parser.add_argument('--cpu', type=int, default=0,
+                        help="Loop iterations each fake tool runs (to burn cpu).")
+    parser.add_argument('--keep', action='store_true',
+                        help="Keep the temporary directory.")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    options = parse_args()
+    tmp_dir = tempfile.mkdtemp(prefix='kiwix-build-bench-')
+    bin_dir = pj(tmp_dir, 'bin')
+    os.makedirs(bin_dir)
+    for tool, content in FAKE_TOOLS.items():
+        write_script(pj(bin_dir, tool), content)
+    os.environ['PATH'] = bin_dir + ':' + os.environ['PATH']
+    os.environ['KB_BENCH_SLEEP'] = str(options.sleep)
+    os.environ['KB_BENCH_CPU'] = str(options.cpu)
+    # Don't probe (or cache the probes of) the real host.
+    kiwix_build.HOST_PROBES.path = pj(tmp_dir, 'host_probes.json')
+    kiwix_build.BuildEnv._detect_distname = staticmethod(lambda: 'benchmark')
+    report = Report()
+    try:
+        bench_micro(report, tmp_dir, options)
+        for shape in options.graphs:
+            bench_graph(report, shape, tmp_dir, pj(tmp_dir, 'work-' + shape), options)
+    finally:
+        if options.keep:
+            print("Benchmark data kept in", tmp_dir)
+        else:
+            shutil.rmtree(tmp_dir)
@@ -1,3 +1,4 @@
+import os
 import shutil
 
 from dependency_utils import (
@@ -40,6 +41,9 @@ class zlib(Dependency):
 
         def _pre_build_script(self, context):
             context.try_skip(self.build_path)
+            # Run again (the recipe has changed): start from a clean copy.
+            if os.path.exists(self.build_path):
+                shutil.rmtree(self.build_path)
             shutil.copytree(self.source_path, self.build_path)
 
         @property
@@ -189,6 +193,10 @@ class Icu(Dependency):
         data = Remotefile('icudt56l.dat',
                           'e23d85eee008f335fc49e8ef37b1bc2b222db105476111e3d16f0007d371cbca')
 
+        @property
+        def recipe(self):
+            return super().recipe + [self.data.sha256]
+
         def _download_data(self, context):
             self.buildEnv.download(self.data)
 
@@ -196,10 +204,12 @@ class Icu(Dependency):
             context.try_skip(self.extract_path)
             shutil.copyfile(pj(self.buildEnv.archive_dir, self.data.name), pj(self.extract_path, 'source', 'data', 'in', self.data.name))
 
-        def prepare(self):
-            super().prepare()
-            self.command("download_data", self._download_data)
-            self.command("copy_data", self._copy_data)
+        def _plan_download_data(self):
+            return self.buildEnv.plan_download(self.data)
+
+        @property
+        def prepare_steps(self):
+            return super().prepare_steps + ['download_data', 'copy_data']
 
     class Builder(MakeBuilder):
         subsource_dir = "source"
@@ -1,12 +1,91 @@
 import subprocess
 import os
+import re
 import shutil
-
-from utils import pj, Context, SkipCommand, extract_archive, Defaultdict, StopBuild
+import time
+
+from utils import (
+    pj,
+    Context,
+    SkipCommand,
+    extract_archive,
+    Defaultdict,
+    StopBuild,
+    print_status,
+    get_sha256,
+    get_recipe_hash,
+    snapshot_dir,
+    read_install_manifest,
+    thread_cpu_times,
+    file_lock,
+    plan_marker,
+    tail_file,
+    compress_log,
+    compressed_log_path)
 
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
 
 
+class Target:
+    """Base class of everything kiwix-build has to prepare and build
+       (dependencies and toolchains)."""
+    force_native_build = False
+    recipe_hash = None
+    dependencies = []
+
+    @property
+    def _log_dir(self):
+        return self.buildEnv.log_dir
+
+    def command(self, name, function, *args, fingerprint=None, stage=None):
+        status = "  {}{} {} : ".format(self.buildEnv.status_tag, name, self.name)
+        log = pj(self._log_dir, 'cmd_{}_{}.log'.format(name, self.name))
+        context = Context(name, log, self.force_native_build, fingerprint)
+        result = "ERROR"
+        start = time.time()
+        cpu_times = thread_cpu_times()
+        try:
+            ret = function(*args, context=context)
+            context._finalise()
+            result = "OK"
+            if context.note:
+                print_status("{}{} ({})".format(status, result, context.note))
+            else:
+                print_status(status + result)
+            return ret
+        except SkipCommand:
+            result = "SKIP"
+            print_status(status + result)
+        except subprocess.CalledProcessError:
+            log_tail = self.buildEnv.options.log_tail
+            try:
+                lines = tail_file(log, log_tail)
+                # The log is compressed (in finally) once the command is done.
+                full_log = compressed_log_path(log, self.buildEnv.options.compress_logs)
+                status += "ERROR (last {} lines of {})\n{}".format(log_tail, full_log, "".join(lines))
+            except OSError:
+                status += "ERROR"
+            print_status(status)
+            raise StopBuild()
+        except:
+            print_status(status + "ERROR")
+            raise
+        finally:
+            # Time spent in kiwix-build itself (extraction, hash, ...)
+            context.add_usage({'user_time': thread_cpu_times()[0] - cpu_times[0],
+                               'system_time': thread_cpu_times()[1] - cpu_times[1]})
+            record = {'target': self.name,
+                      'stage': stage,
+                      'command': name,
+                      'status': result,
+                      'note': context.note,
+                      'start': start,
+                      'wall_time': time.time() - start}
+            record.update(context.usage)
+            self.buildEnv.profiler.add(record)
+            compress_log(log, self.buildEnv.options.compress_logs)
+
+
 class _MetaDependency(type):
     def __new__(cls, name, bases, dct):
         _class = type.__new__(cls, name, bases, dct)
@@ -16,10 +95,9 @@ class _MetaDependency(type):
         return _class
 
 
-class Dependency(metaclass=_MetaDependency):
+class Dependency(Target, metaclass=_MetaDependency):
     all_deps = {}
     dependencies = []
-    force_native_build = False
     version = None
 
     def __init__(self, buildEnv):
@@ -27,6 +105,7 @@ class Dependency(metaclass=_MetaDependency):
         self.source = self.Source(self)
         self.builder = self.Builder(self)
         self.skip = False
+        self._recipe_hash = None
 
     @property
     def full_name(self):
@@ -39,31 +118,27 @@ class Dependency(metaclass=_MetaDependency):
         return pj(self.buildEnv.source_dir, self.source.source_dir)
 
     @property
-    def _log_dir(self):
-        return self.buildEnv.log_dir
-
-    def command(self, name, function, *args):
-        print("  {} {} : ".format(name, self.name), end="", flush=True)
-        log = pj(self._log_dir, 'cmd_{}_{}.log'.format(name, self.name))
-        context = Context(name, log, self.force_native_build)
-        try:
-            ret = function(*args, context=context)
-            context._finalise()
-            print("OK")
-            return ret
-        except SkipCommand:
-            print("SKIP")
-        except subprocess.CalledProcessError:
-            print("ERROR")
-            try:
-                with open(log, 'r') as f:
-                    print(f.read())
-            except:
-                pass
-            raise StopBuild()
-        except:
-            print("ERROR")
-            raise
+    def recipe_hash(self):
+        """A hash of everything defining what this dependency installs.
+           None if it cannot be known (source not prepared)."""
+        if self._recipe_hash is None:
+            source_recipe = self.source.recipe
+            if source_recipe is None:
+                return None
+            recipe = [self.name, self.version, self.force_native_build,
+                      source_recipe, self.builder.recipe, self.buildEnv.recipe]
+            for depName in self.dependencies:
+                dep = self.buildEnv.targetsDict.get(depName)
+                if dep is None or dep.skip:
+                    # Provided by the system
+                    recipe.append(depName)
+                    continue
+                dep_hash = dep.recipe_hash
+                if dep_hash is None:
+                    return None
+                recipe.append(dep_hash)
+            self._recipe_hash = get_recipe_hash(recipe)
+        return self._recipe_hash
 
 
 class Source:
@@ -82,8 +157,41 @@ class Source:
     def source_dir(self):
         return self.target.full_name
 
-    def command(self, *args, **kwargs):
-        return self.target.command(*args, **kwargs)
+    @property
+    def recipe(self):
+        return []
+
+    @property
+    def prepare_steps(self):
+        """The names of the steps (a `_<name>` method each) of prepare()."""
+        return []
+
+    @property
+    def commit(self):
+        """The commit of the sources, if they come from a repository."""
+        return None
+
+    def _fingerprint(self, name):
+        recipe = self.recipe
+        return get_recipe_hash([recipe, name]) if recipe is not None else None
+
+    def command(self, name, function, *args):
+        return self.target.command(name, function, *args,
+                                   fingerprint=self._fingerprint(name), stage='source')
+
+    def prepare(self):
+        for name in self.prepare_steps:
+            self.command(name, getattr(self, '_'+name))
+
+    def _plan_marker(self, name):
+        return plan_marker(pj(self.buildEnv.source_dir, self.source_dir),
+                           name, self._fingerprint(name))
+
+    def plan(self):
+        """What prepare() would do, as a list of (step, action), action
+           being 'run', 'skip' or 'maybe' (decided when run)."""
+        return [(name, getattr(self, '_plan_'+name, lambda: self._plan_marker(name))())
+                for name in self.prepare_steps]
 
 
 class ReleaseDownload(Source):
@@ -93,30 +201,53 @@ class ReleaseDownload(Source):
     def extract_path(self):
         return pj(self.buildEnv.source_dir, self.source_dir)
 
+    @property
+    def recipe(self):
+        patches = [get_sha256(pj(SCRIPT_DIR, 'patches', p))
+                   for p in getattr(self, 'patches', [])]
+        return [self.archive.sha256, patches]
+
     def _download(self, context):
         self.buildEnv.download(self.archive)
 
-    def _extract(self, context):
-        context.try_skip(self.extract_path)
+    def _plan_download(self):
+        return self.buildEnv.plan_download(self.archive)
+
+    def _plan_marker(self, name):
+        if name != 'extract' and super()._plan_marker('extract') == 'run':
+            # The extract dir is replaced, with the markers of the next steps.
+            return 'run'
+        return super()._plan_marker(name)
+
+    def _extract_archive(self):
         if os.path.exists(self.extract_path):
             shutil.rmtree(self.extract_path)
-        extract_archive(pj(self.buildEnv.archive_dir, self.archive.name),
-                        self.buildEnv.source_dir,
-                        topdir=self.archive_top_dir,
-                        name=self.source_dir)
+        self._extracted = True
+        return extract_archive(pj(self.buildEnv.archive_dir, self.archive.name),
+                               self.buildEnv.source_dir,
+                               topdir=self.archive_top_dir,
+                               name=self.source_dir)
+
+    def _extract(self, context):
+        context.try_skip(self.extract_path)
+        context.note = self._extract_archive()
 
     def _patch(self, context):
         context.try_skip(self.extract_path)
+        if not getattr(self, '_extracted', False):
+            # The sources may already be (partially) patched.
+            context.note = self._extract_archive()
         context.force_native_build = True
         for p in self.patches:
             with open(pj(SCRIPT_DIR, 'patches', p), 'r') as patch_input:
                 self.buildEnv.run_command("patch -p1", self.extract_path, context, input=patch_input)
 
-    def prepare(self):
-        self.command('download', self._download)
-        self.command('extract', self._extract)
+    @property
+    def prepare_steps(self):
+        steps = ['download', 'extract']
         if hasattr(self, 'patches'):
-            self.command('patch', self._patch)
+            steps.append('patch')
+        return steps
 
 
 class GitClone(Source):
@@ -130,23 +261,137 @@ class GitClone(Source):
     def git_path(self):
         return pj(self.buildEnv.source_dir, self.git_dir)
 
-    def _git_clone(self, context):
+    @property
+    def commit(self):
+        try:
+            return self._git_output('rev-parse', 'HEAD')
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    @property
+    def recipe(self):
+        commit = self.commit
+        return [commit] if commit else None
+
+    @property
+    def mirror_path(self):
+        """A bare mirror of git_remote shared by all working dirs, if any."""
+        if not self.buildEnv.options.git_mirror_dir:
+            return None
+        name = re.sub(r'[^A-Za-z0-9.-]+', '_', self.git_remote)
+        return pj(self.buildEnv.options.git_mirror_dir, name)
+
+    @property
+    def pinned_commit(self):
+        if re.match(r'^[0-9a-f]{40}$', self.git_ref):
+            return self.git_ref
+        return None
+
+    def _git_output(self, *args):
+        return subprocess.check_output(('git',) + args,
+                                       cwd=self.git_path,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+
+    def _remote_commit(self):
+        """The commit git_ref points to on the remote (None if unknown)."""
+        try:
+            output = self._git_output('ls-remote', self.git_remote,
+                                      self.git_ref, self.git_ref+'^{}')
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        refs = dict(reversed(line.split()) for line in output.splitlines())
+        for ref in ('refs/heads/{}', 'refs/tags/{}^{{}}', 'refs/tags/{}', '{}'):
+            ref = ref.format(self.git_ref)
+            if ref in refs:
+                return refs[ref]
+        return None
+
+    def _update_mirror(self, context):
+        os.makedirs(self.buildEnv.options.git_mirror_dir, exist_ok=True)
+        with file_lock(self.mirror_path + '.lock'):
+            if os.path.exists(self.mirror_path):
+                command = "git remote update --prune"
+                self.buildEnv.run_command(command, self.mirror_path, context)
+            else:
+                command = "git clone --mirror {} {}".format(self.git_remote, self.mirror_path)
+                self.buildEnv.run_command(command, self.buildEnv.options.git_mirror_dir, context)
+
+    def _gitclone(self, context):
         context.force_native_build = True
         if os.path.exists(self.git_path):
             raise SkipCommand()
-        command = "git clone --depth=1 {} {}".format(self.git_remote, self.git_dir)
+        if self.mirror_path:
+            self._update_mirror(context)
+            # Copy the objects we need from the mirror, so a gc in the mirror
+            # never breaks our clone.
+            command = "git clone --reference-if-able {} --dissociate {} {}".format(
+                self.mirror_path, self.git_remote, self.git_dir)
+        else:
+            command = "git clone --depth=1 {} {}".format(self.git_remote, self.git_dir)
         self.buildEnv.run_command(command, self.buildEnv.source_dir, context)
 
-    def _git_update(self, context):
+    def _gitupdate(self, context):
         context.force_native_build = True
-        self.buildEnv.run_command("git fetch", self.git_path, context)
+        head = self._git_output('rev-parse', 'HEAD')
+        if self.pinned_commit:
+            if head == self.pinned_commit:
+                raise SkipCommand()
+            try:
+                self._git_output('cat-file', '-e', self.pinned_commit+'^{commit}')
+                need_fetch = False
+            except subprocess.CalledProcessError:
+                need_fetch = True
+        else:
+            if head == self._remote_commit():
+                raise SkipCommand()
+            need_fetch = True
+
+        if need_fetch:
+            if self.mirror_path:
+                self._update_mirror(context)
+            command = "git fetch origin {}".format(self.git_ref)
+            self.buildEnv.run_command(command, self.git_path, context)
+        if self.pinned_commit:
+            self.buildEnv.run_command("git checkout "+self.pinned_commit, self.git_path, context)
+            return
+        try:
+            self._git_output('show-ref', '--verify', 'refs/heads/'+self.git_ref)
+        except subprocess.CalledProcessError:
+            # A tag (or a branch we don't have locally)
+            self.buildEnv.run_command("git checkout FETCH_HEAD", self.git_path, context)
+            return
         self.buildEnv.run_command("git checkout "+self.git_ref, self.git_path, context)
+        try:
+            self._git_output('merge-base', '--is-ancestor', 'HEAD', 'FETCH_HEAD')
+        except subprocess.CalledProcessError:
+            # Local changes, don't touch them.
+            return
+        self.buildEnv.run_command("git merge --ff-only FETCH_HEAD", self.git_path, context)
 
-    def prepare(self):
-        self.command('gitclone', self._git_clone)
-        self.command('gitupdate', self._git_update)
+    @property
+    def prepare_steps(self):
+        steps = ['gitclone', 'gitupdate']
         if hasattr(self, '_post_prepare_script'):
-            self.command('post_prepare_script', self._post_prepare_script)
+            steps.append('post_prepare_script')
+        return steps
+
+    def _plan_gitclone(self):
+        return 'skip' if os.path.exists(self.git_path) else 'run'
+
+    def _plan_gitupdate(self):
+        if self._plan_gitclone() == 'skip' and self.pinned_commit:
+            try:
+                if self._git_output('rev-parse', 'HEAD') == self.pinned_commit:
+                    return 'skip'
+            except subprocess.CalledProcessError:
+                pass
+        # Depends on the remote
+        return 'maybe'
+
+    def _plan_marker(self, name):
+        if self._plan_gitclone() == 'run':
+            return 'run'
+        return super()._plan_marker(name)
 
 
 class Builder:
@@ -155,6 +400,7 @@ class Builder:
     def __init__(self, target):
         self.target = target
         self.buildEnv = target.buildEnv
+        self.stamp = None
 
     @property
     def name(self):
@@ -171,17 +417,138 @@ class Builder:
     def build_path(self):
         return pj(self.buildEnv.build_dir, self.target.full_name)
 
-    def command(self, *args, **kwargs):
-        return self.target.command(*args, **kwargs)
+    @property
+    def recipe(self):
+        return [self.subsource_dir]
 
-    def build(self):
+    @property
+    def build_steps(self):
+        """The names of the steps (a `_<name>` method each) of build().
+           The steps from 'install' are run under the install lock."""
+        steps = []
         if hasattr(self, '_pre_build_script'):
-            self.command('pre_build_script', self._pre_build_script)
-        self.command('configure', self._configure)
-        self.command('compile', self._compile)
-        self.command('install', self._install)
+            steps.append('pre_build_script')
+        steps += ['configure', 'compile', 'install']
         if hasattr(self, '_post_build_script'):
-            self.command('post_build_script', self._post_build_script)
+            steps.append('post_build_script')
+        return steps
+
+    def _fingerprint(self, name, stamp):
+        if self.target.recipe_hash is None:
+            return None
+        return get_recipe_hash([self.target.recipe_hash, name, stamp])
+
+    def _next_stamp(self, name, fingerprint):
+        autoskip_file = pj(self.build_path, ".{}_ok".format(name))
+        if os.path.exists(autoskip_file):
+            return get_recipe_hash([self.stamp, fingerprint,
+                                    os.stat(autoskip_file).st_mtime_ns])
+        return self.stamp
+
+    def command(self, name, function, *args):
+        """Run a build step.
+           The fingerprint of a step depends on the recipe of the target and
+           on the previous steps, so if a step is run again, all the following
+           ones are too."""
+        fingerprint = self._fingerprint(name, self.stamp)
+        ret = self.target.command(name, function, *args,
+                                  fingerprint=fingerprint, stage='build')
+        self.stamp = self._next_stamp(name, fingerprint)
+        return ret
+
+    def _dependencies_stamp(self):
+        deps = (self.buildEnv.targetsDict.get(d) for d in self.target.dependencies)
+        stamps = [d.builder.stamp for d in deps if d and not d.skip]
+        if None in stamps:
+            return None
+        return get_recipe_hash(stamps)
+
+    def _plan_marker(self, name, fingerprint):
+        return plan_marker(self.build_path, name, fingerprint)
+
+    def plan(self):
+        """What build() would do, as a list of (step, action) (see
+           Source.plan()), based on the markers of the previous build.
+           self.stamp is set as build() would set it, or to None if it will
+           change (as a step will be run again)."""
+        self.stamp = self._dependencies_stamp()
+        if (self.buildEnv.artifact_cache and self.target.recipe_hash
+            and self.buildEnv.artifact_cache.has(self.name, self.target.recipe_hash)):
+            if self.stamp is not None:
+                self.stamp = get_recipe_hash([self.stamp, self.target.recipe_hash])
+            return [('restore_artifact', 'run')]
+        plan = []
+        for name in self.build_steps:
+            fingerprint = self._fingerprint(name, self.stamp)
+            if self.stamp is None and fingerprint is not None:
+                action = 'run'
+            else:
+                planner = getattr(self, '_plan_'+name, self._plan_marker)
+                action = planner(name, fingerprint)
+            if action == 'skip':
+                self.stamp = self._next_stamp(name, fingerprint)
+            elif os.path.exists(pj(self.build_path, ".{}_ok".format(name))):
+                # The marker will be written again.
+                self.stamp = None
+            plan.append((name, action))
+        if (self.buildEnv.artifact_cache and self.target.recipe_hash
+            and any(action != 'skip' for _, action in plan)):
+            plan.append(('store_artifact', 'maybe'))
+        return plan
+
+    def _restore_artifact(self, context):
+        if not self.buildEnv.artifact_cache.restore(self.name,
+                                                    self.target.recipe_hash,
+                                                    self.buildEnv.install_dir):
+            raise SkipCommand()
+        return True
+
+    @property
+    def install_manifest(self):
+        """The file listing what the install step installed, if any."""
+        return None
+
+    def _store_artifact(self, installed_before, context):
+        # Files "up to date" in the install dir are not written again, but are
+        # in the install manifest.
+        installed_after = snapshot_dir(self.buildEnv.install_dir)
+        files = set(f for f, stat in installed_after.items()
+                    if installed_before.get(f) != stat)
+        if self.install_manifest:
+            files.update(read_install_manifest(self.install_manifest,
+                                               self.buildEnv.install_dir) or [])
+        if not files:
+            # Nothing installed (or everything used in place, as icu4c_native).
+            raise SkipCommand()
+        self.buildEnv.artifact_cache.store(self.name,
+                                           self.target.recipe_hash,
+                                           self.buildEnv.install_dir,
+                                           files)
+
+    def build(self):
+        # Dependencies which have been built again invalidate our steps.
+        self.stamp = self._dependencies_stamp()
+        use_cache = self.buildEnv.artifact_cache and self.target.recipe_hash
+        if use_cache:
+            # Don't restore in the middle of the install of another dependency.
+            with self.buildEnv.install_lock:
+                restored = self.command('restore_artifact', self._restore_artifact)
+            if restored:
+                self.stamp = get_recipe_hash([self.stamp, self.target.recipe_hash])
+                return
+        steps = self.build_steps
+        install_index = steps.index('install') if 'install' in steps else len(steps)
+        for name in steps[:install_index]:
+            self.command(name, getattr(self, '_'+name))
+        # Dependencies may be built in parallel, but only one is installed at
+        # a time so we know which files each one installs.
+        with self.buildEnv.install_lock:
+            if use_cache:
+                installed_before = snapshot_dir(self.buildEnv.install_dir)
+            for name in steps[install_index:]:
+                self.command(name, getattr(self, '_'+name))
+            if use_cache:
+                self.command('store_artifact', self._store_artifact, installed_before)
 
 
 class MakeBuilder(Builder):
@@ -195,6 +562,16 @@ class MakeBuilder(Builder):
     make_target = ""
     make_install_target = "install"
 
+    @property
+    def recipe(self):
+        return super().recipe + [
+            self.configure_script,
+            self.all_configure_option,
+            sorted((self.configure_env or {}).items()),
+            self.make_target,
+            self.make_option,
+            self.make_install_target]
+
     @property
     def all_configure_option(self):
         return "{} {} {}".format(
@@ -202,6 +579,14 @@ class MakeBuilder(Builder):
             self.static_configure_option if self.buildEnv.platform_info.static else self.dynamic_configure_option,
             self.buildEnv.configure_option if not self.target.force_native_build else "")
 
+    def _update_configure_env(self, env):
+        # configure_env is shared by all the build envs, don't modify it.
+        for k, v in (self.configure_env or {}).items():
+            if k.startswith('_format_'):
+                v = v.format(buildEnv=self.buildEnv, env=env)
+                k = k[8:]
+            env[k] = v
+
     def _configure(self, context):
         context.try_skip(self.build_path)
         command = "{configure_script} {configure_option} --prefix {install_dir} --libdir {libdir}"
@@ -214,18 +599,13 @@ class MakeBuilder(Builder):
         env = Defaultdict(str, os.environ)
         if self.buildEnv.platform_info.static:
             env['CFLAGS'] = env['CFLAGS'] + ' -fPIC'
-        if self.configure_env:
-            for k in self.configure_env:
-                if k.startswith('_format_'):
-                    v = self.configure_env.pop(k)
-                    v = v.format(buildEnv=self.buildEnv, env=env)
-                    self.configure_env[k[8:]] = v
-            env.update(self.configure_env)
+        self._update_configure_env(env)
         self.buildEnv.run_command(command, self.build_path, context, env=env)
 
     def _compile(self, context):
         context.try_skip(self.build_path)
-        command = "make -j4 {make_target} {make_option}".format(
+        # The number of jobs is given by the jobserver in MAKEFLAGS
+        command = "make {make_target} {make_option}".format(
             make_target=self.make_target,
             make_option=self.make_option
         )
@@ -241,9 +621,18 @@ class MakeBuilder(Builder):
 
 
 class CMakeBuilder(MakeBuilder):
+    @property
+    def recipe(self):
+        return super().recipe + [self.buildEnv.cmake_option]
+
+    @property
+    def install_manifest(self):
+        return pj(self.build_path, 'install_manifest.txt')
+
     def _configure(self, context):
         context.try_skip(self.build_path)
         command = ("cmake {configure_option}"
+                   " {launcher_option}"
                    " -DCMAKE_VERBOSE_MAKEFILE:BOOL=ON"
                    " -DCMAKE_INSTALL_PREFIX={install_dir}"
                    " -DCMAKE_INSTALL_LIBDIR={libdir}"
@@ -251,6 +640,7 @@ class CMakeBuilder(MakeBuilder):
                    " {cross_option}")
         command = command.format(
             configure_option="{} {}".format(self.buildEnv.cmake_option, self.configure_option),
+            launcher_option=self.buildEnv.cmake_launcher_option,
             install_dir=self.buildEnv.install_dir,
             libdir=self.buildEnv.libprefix,
             source_path=self.source_path,
@@ -259,13 +649,7 @@ class CMakeBuilder(MakeBuilder):
         env = Defaultdict(str, os.environ)
         if self.buildEnv.platform_info.static:
             env['CFLAGS'] = env['CFLAGS'] + ' -fPIC'
-        if self.configure_env:
-            for k in self.configure_env:
-                if k.startswith('_format_'):
-                    v = self.configure_env.pop(k)
-                    v = v.format(buildEnv=self.buildEnv, env=env)
-                    self.configure_env[k[8:]] = v
-            env.update(self.configure_env)
+        self._update_configure_env(env)
         self.buildEnv.run_command(command, self.build_path, context, env=env, cross_path_only=True)
 
 
@@ -276,13 +660,25 @@ class MesonBuilder(Builder):
     def library_type(self):
         return 'static' if self.buildEnv.platform_info.static else 'shared'
 
+    @property
+    def recipe(self):
+        return super().recipe + [
+            self.configure_option.format(buildEnv=self.buildEnv),
+            self.library_type]
+
     def _configure(self, context):
         context.try_skip(self.build_path)
-        if os.path.exists(self.build_path):
+        reconfigure = ""
+        if os.path.exists(pj(self.build_path, 'meson-private', 'coredata.dat')):
+            # Keep the build dir, ninja will only rebuild what has changed.
+            if self.buildEnv.meson_version >= (0, 45):
+                reconfigure = "--reconfigure"
+        if not reconfigure and os.path.exists(self.build_path):
             shutil.rmtree(self.build_path)
-        os.makedirs(self.build_path)
+        os.makedirs(self.build_path, exist_ok=True)
         configure_option = self.configure_option.format(buildEnv=self.buildEnv)
         command = ("{command} . {build_path}"
+                   " {reconfigure}"
                    " --default-library={library_type}"
                    " {configure_option}"
                    " --prefix={buildEnv.install_dir}"
@@ -290,6 +686,7 @@ class MesonBuilder(Builder):
                    " {cross_option}")
         command = command.format(
             command=self.buildEnv.meson_command,
+            reconfigure=reconfigure,
             library_type=self.library_type,
             configure_option=configure_option,
             build_path=self.build_path,
@@ -298,10 +695,34 @@ class MesonBuilder(Builder):
         )
         self.buildEnv.run_command(command, self.source_path, context, cross_path_only=True)
 
+    @property
+    def install_manifest(self):
+        return pj(self.build_path, 'meson-logs', 'install-log.txt')
+
+    def _ninja_is_up_to_date(self):
+        output = subprocess.check_output([self.buildEnv.ninja_command, '-n'],
+                                         cwd=self.build_path)
+        return b"no work to do" in output
+
+    def _plan_compile(self, name, fingerprint):
+        if self._plan_marker(name, fingerprint) == 'run':
+            return 'run'
+        try:
+            return 'skip' if self._ninja_is_up_to_date() else 'run'
+        except (OSError, subprocess.CalledProcessError):
+            return 'run'
+
     def _compile(self, context):
-        command = "{} -v".format(self.buildEnv.ninja_command)
+        # ninja decides what has to be rebuilt. The marker is only written if
+        # something was, so the install step can be skipped otherwise.
+        if self._ninja_is_up_to_date():
+            context.try_skip(self.build_path)
+        else:
+            context.autoskip_file = pj(self.build_path, ".compile_ok")
+        command = "{} -v {}".format(self.buildEnv.ninja_command, self.buildEnv.ninja_option)
         self.buildEnv.run_command(command, self.build_path, context)
 
     def _install(self, context):
-        command = "{} -v install".format(self.buildEnv.ninja_command)
+        context.try_skip(self.build_path)
+        command = "{} -v {} install".format(self.buildEnv.ninja_command, self.buildEnv.ninja_option)
         self.buildEnv.run_command(command, self.build_path, context)
@@ -3,21 +3,41 @@
 import os, sys, stat
 import argparse
 import ssl
-import urllib.request
 import subprocess
 import platform
+import threading
+import time
+import json
 from collections import OrderedDict
 
 from dependencies import Dependency
-from dependency_utils import ReleaseDownload, Builder
+from dependency_utils import Target, ReleaseDownload, Builder
 from utils import (
     pj,
-    remove_duplicates,
+    print_status,
     get_sha256,
+    download_file,
+    ArchiveStore,
+    ArtifactCache,
     StopBuild,
     SkipCommand,
     Defaultdict,
     Remotefile,
+    Scheduler,
+    DependencyGraph,
+    JobServer,
+    detect_cpu_count,
+    wait_process,
+    read_ccache_statslog,
+    which,
+    ProbeCache,
+    Profiler,
+    get_recipe_hash,
+    LOG_COMPRESSIONS,
+    zstandard,
+    BuildHistory,
+    critical_path,
+    simulate_schedule,
     Context)
 
 REMOTE_PREFIX = 'http://download.kiwix.org/dev/'
@@ -136,10 +156,8 @@ PACKAGE_NAME_MAPPERS = {
 }
 
 
-def which(name):
-    command = "which {}".format(name)
-    output = subprocess.check_output(command, shell=True)
-    return output[:-1].decode()
+HOST_PROBES = ProbeCache(pj(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+                            'kiwix-build', 'host_probes.json'))
 
 
 class TargetInfo:
@@ -184,35 +202,59 @@ class BuildEnv:
         'android_x86_64': AndroidTargetInfo('x86_64'),
     }
 
-    def __init__(self, options, targetsDict):
+    def __init__(self, options, target_platform, targetsDict, jobserver):
+        self.target_platform = target_platform
         self.source_dir = pj(options.working_dir, "SOURCE")
-        build_dir = "BUILD_{}".format(options.target_platform)
+        build_dir = "BUILD_{}".format(target_platform)
         self.build_dir = pj(options.working_dir, build_dir)
         self.archive_dir = pj(options.working_dir, "ARCHIVE")
         self.log_dir = pj(self.build_dir, 'LOGS')
         self.install_dir = pj(self.build_dir, "INSTALL")
+        self.options = options
+        self.detect_platform()
+        self.setup_build(target_platform)
+        self.setup_toolchains()
+        self.targetsDict = targetsDict
+        self.install_lock = threading.Lock()
+        self._env_lock = threading.Lock()
+        self._dumped_envs = set()
+        self.profiler = Profiler(target_platform)
+        self.jobserver = jobserver
+        self.host_prepared = False
+        self.status_tag = ""
+        self.artifact_cache = None
+        if options.artifact_cache:
+            self.artifact_cache = ArtifactCache(options.artifact_cache)
+        self.archive_store = None
+        if options.archive_store:
+            self.archive_store = ArchiveStore(options.archive_store,
+                                              options.archive_store_size*1024*1024)
+
+    def prepare_host(self):
+        """Create the working dirs and check the tools we need are here.
+           (Not needed by the commands only looking at the targets.)"""
         for d in (self.source_dir,
                   self.build_dir,
                   self.archive_dir,
                   self.log_dir,
                   self.install_dir):
             os.makedirs(d, exist_ok=True)
-        self.detect_platform()
-        self.ninja_command = self._detect_ninja()
+        self.host_prepared = True
         if not self.ninja_command:
             sys.exit("ERROR: ninja command not found")
-        self.meson_command = self._detect_meson()
         if not self.meson_command:
             sys.exit("ERROR: meson command not found")
-        self.setup_build(options.target_platform)
-        self.setup_toolchains()
-        self.options = options
-        self.libprefix = options.libprefix or self._detect_libdir()
-        self.targetsDict = targetsDict
 
     def detect_platform(self):
+        self.distname = HOST_PROBES.get('distname', ['/etc/os-release'],
+                                        self._detect_distname)
+
+    # The host detections are cached in HOST_PROBES (for all the build envs
+    # and between runs).
+    @staticmethod
+    def _detect_distname():
         _platform = platform.system()
-        self.distname = _platform
+        distname = _platform
         if _platform == 'Windows':
             print('ERROR: kiwix-build is not intented to run on Windows platform.\n'
                   'It should probably not work, but well, you still can have a try.')
@@ -223,10 +265,11 @@ class BuildEnv:
             print('WARNING: kiwix-build has not been tested on MacOS platfrom.\n'
                   'Tests, bug reports and patches are welcomed.')
         if _platform == 'Linux':
-            self.distname, _, _ = platform.linux_distribution()
-            self.distname = self.distname.lower()
-            if self.distname == 'ubuntu':
-                self.distname = 'debian'
+            distname, _, _ = platform.linux_distribution()
+            distname = distname.lower()
+            if distname == 'ubuntu':
+                distname = 'debian'
+        return distname
 
     def setup_build(self, target_platform):
         self.platform_info = platform_info = self.target_platforms[target_platform]
@@ -279,13 +322,19 @@ class BuildEnv:
         self.meson_crossfile = self._gen_crossfile('meson_cross_file.txt')
 
     def __getattr__(self, name):
+        if isinstance(getattr(type(self), name, None), property):
+            # The property raised an AttributeError: raise it again instead
+            # of looking for name in the options.
+            return object.__getattribute__(self, name)
         return getattr(self.options, name)
 
-    def _is_debianlike(self):
+    @staticmethod
+    def _is_debianlike():
         return os.path.isfile('/etc/debian_version')
 
-    def _detect_libdir(self):
-        if self._is_debianlike():
+    @staticmethod
+    def _detect_libdir():
+        if BuildEnv._is_debianlike():
             try:
                 pc = subprocess.Popen(['dpkg-architecture', '-qDEB_HOST_MULTIARCH'],
                                       stdout=subprocess.PIPE,
@@ -300,27 +349,93 @@ class BuildEnv:
             return 'lib64'
         return 'lib'
 
-    def _detect_ninja(self):
+    @staticmethod
+    def _detect_ninja():
         for n in ['ninja', 'ninja-build']:
             try:
-                retcode = subprocess.check_call([n, '--version'],
-                                                stdout=subprocess.DEVNULL)
-            except (FileNotFoundError, PermissionError):
+                output = subprocess.check_output([n, '--version'])
+            except (FileNotFoundError, PermissionError, subprocess.CalledProcessError):
                 # Doesn't exist in PATH or isn't executable
                 continue
-            if retcode == 0:
-                return n
+            version = tuple(int(v) for v in output.decode().split('.')[:2] if v.isdigit())
+            return n, version
+        return None, ()
+
+    @property
+    def libprefix(self):
+        if self.options.libprefix:
+            return self.options.libprefix
+        return HOST_PROBES.get('libdir',
+                               ['dpkg-architecture', '/etc/debian_version', '/usr/lib64'],
+                               self._detect_libdir)
 
-    def _detect_meson(self):
+    @property
+    def ninja_command(self):
+        return HOST_PROBES.get('ninja', ['ninja', 'ninja-build'], self._detect_ninja)[0]
+
+    @property
+    def ninja_version(self):
+        return tuple(HOST_PROBES.get('ninja', ['ninja', 'ninja-build'], self._detect_ninja)[1])
+
+    @property
+    def meson_command(self):
+        return HOST_PROBES.get('meson', ['meson.py', 'meson'], self._detect_meson)[0]
+
+    @property
+    def meson_version(self):
+        return tuple(HOST_PROBES.get('meson', ['meson.py', 'meson'], self._detect_meson)[1])
+
+    @property
+    def ninja_option(self):
+        # Ninja (even >= 1.13, which only joins a make 4.4 fifo jobserver)
+        # doesn't use our pipe: give it its share of the jobs explicitly.
+        return "-j{}".format(max(1, self.jobserver.jobs // self.options.jobs_deps))
+
+    @staticmethod
+    def _detect_meson():
         for n in ['meson.py', 'meson']:
             try:
-                retcode = subprocess.check_call([n, '--version'],
-                                                stdout=subprocess.DEVNULL)
-            except (FileNotFoundError, PermissionError):
+                output = subprocess.check_output([n, '--version'])
+            except (FileNotFoundError, PermissionError, subprocess.CalledProcessError):
                 # Doesn't exist in PATH or isn't executable
                 continue
-            if retcode == 0:
-                return n
+            version = tuple(int(v) for v in output.decode().split('.')[:2] if v.isdigit())
+            return n, version
+        return None, ()
+
+    @property
+    def compiler_launcher(self):
+        if self.options.compiler_launcher == 'none':
+            return None
+        return which(self.options.compiler_launcher)
+
+    @property
+    def ccache(self):
+        return (self.compiler_launcher is not None
+                and os.path.basename(self.compiler_launcher).startswith('ccache'))
+
+    @property
+    def cmake_launcher_option(self):
+        if not self.compiler_launcher:
+            return ""
+        return ("-DCMAKE_C_COMPILER_LAUNCHER={0}"
+                " -DCMAKE_CXX_COMPILER_LAUNCHER={0}").format(self.compiler_launcher)
+
+    def setup_ccache(self):
+        if not self.ccache or not self.options.ccache_max_size:
+            return
+        env = self._set_env(None, False, False)
+        subprocess.check_call([self.compiler_launcher, '--max-size', self.options.ccache_max_size],
+                              env=env, stdout=subprocess.DEVNULL)
+
+    @property
+    def recipe(self):
+        return [self.target_platform,
+                self.distname,
+                self.install_dir,
+                self.libprefix,
+                sorted((k, repr(v)) for k, v in self.cross_env.items()),
+                [(tlc.name, getattr(tlc, 'version', None)) for tlc in self.toolchains]]
 
     @property
     def configure_option(self):
@@ -352,13 +467,16 @@ class BuildEnv:
         pkgconfig_path = pj(self.install_dir, self.libprefix, 'pkgconfig')
         env['PKG_CONFIG_PATH'] = ':'.join([env['PKG_CONFIG_PATH'], pkgconfig_path])
 
-        # Add ccache path
-        for p in ('/usr/lib/ccache', '/usr/lib64/ccache'):
-            if os.path.isdir(p):
-                ccache_path = [p]
-                break
-        else:
-            ccache_path = []
+        # Add ccache path (for the native compilers, the toolchains set
+        # their own launcher)
+        ccache_path = []
+        if self.ccache:
+            for p in ('/usr/lib/ccache', '/usr/lib64/ccache'):
+                if os.path.isdir(p):
+                    ccache_path = [p]
+                    break
+            if self.options.ccache_dir:
+                env['CCACHE_DIR'] = self.options.ccache_dir
         env['PATH'] = ':'.join(bin_dirs +
                                [pj(self.install_dir, 'bin')] +
                                ccache_path +
@@ -373,8 +491,21 @@ class BuildEnv:
         env['LDFLAGS'] = " ".join(['-L'+pj(self.install_dir, 'lib'),
                                    '-L'+pj(self.install_dir, 'lib64'),
                                    env['LDFLAGS']])
+        env['MAKEFLAGS'] = self.jobserver.makeflags
         return env
 
+    def _dump_env(self, env):
+        """Write env in the env file of this run (once) and return its id."""
+        env_id = get_recipe_hash(sorted(env.items()))[:12]
+        with self._env_lock:
+            if env_id not in self._dumped_envs:
+                with open(pj(self.log_dir, 'env.log'), 'a' if self._dumped_envs else 'w') as f:
+                    print("env {} :".format(env_id), file=f)
+                    for k, v in sorted(env.items()):
+                        print("  {} : {!r}".format(k, v), file=f)
+                self._dumped_envs.add(env_id)
+        return env_id
+
     def run_command(self, command, cwd, context, env=None, input=None, cross_path_only=False):
         os.makedirs(cwd, exist_ok=True)
         cross_compile_env = True
@@ -385,20 +516,40 @@ class BuildEnv:
         if cross_path_only:
             cross_compile_env = False
         env = self._set_env(env, cross_compile_env, cross_compile_path)
+        env_id = self._dump_env(env)
         log = None
         try:
             if not self.options.verbose:
-                log = open(context.log_file, 'w')
+                if not context.log_started:
+                    # Don't keep the (compressed) log of a previous run.
+                    for path in (context.log_file + '.gz', context.log_file + '.zst'):
+                        if os.path.exists(path):
+                            os.remove(path)
+                log = open(context.log_file, 'a' if context.log_started else 'w')
+                context.log_started = True
             print("run command '{}'".format(command), file=log)
             print("current directory is '{}'".format(cwd), file=log)
-            print("env is :", file=log)
-            for k, v in env.items():
-                print("  {} : {!r}".format(k, v), file=log)
+            print("env is {} (in {})".format(env_id, pj(self.log_dir, 'env.log')), file=log, flush=True)
 
             kwargs = dict()
             if input:
                 kwargs['stdin'] = input
-            return subprocess.check_call(command, shell=True, cwd=cwd, env=env, stdout=log or sys.stdout, stderr=subprocess.STDOUT, **kwargs)
+            statslog = None
+            if self.ccache:
+                statslog = context.log_file + '.ccache'
+                if os.path.exists(statslog):
+                    os.remove(statslog)
+                env['CCACHE_STATSLOG'] = statslog
+            process = subprocess.Popen(command, shell=True, cwd=cwd, env=env, stdout=log or sys.stdout, stderr=subprocess.STDOUT, pass_fds=self.jobserver.fds, **kwargs)
+            returncode, usage = wait_process(process)
+            context.add_usage(usage)
+            if statslog:
+                context.add_usage(read_ccache_statslog(statslog))
+                if os.path.exists(statslog):
+                    os.remove(statslog)
+            if returncode:
+                raise subprocess.CalledProcessError(returncode, command)
+            return returncode
         finally:
             if log:
                 log.close()
@@ -409,51 +560,77 @@ class BuildEnv:
         file_url = what.url or (REMOTE_PREFIX + what.name)
         if os.path.exists(file_path):
             if what.sha256 == get_sha256(file_path):
+                if self.archive_store:
+                    self.archive_store.add(what.sha256, file_path)
                 raise SkipCommand()
             os.remove(file_path)
+        if self.archive_store and what.sha256:
+            if self.archive_store.get(what.sha256, file_path):
+                raise SkipCommand()
 
-        if options.no_cert_check == True:
+        if self.options.no_cert_check == True:
             context = ssl.create_default_context()
             context.check_hostname = False
             context.verify_mode = ssl.CERT_NONE
         else:
             context = None
-        batch_size = 1024 * 8
-        extra_args = {'context':context} if sys.version_info >= (3, 4, 3) else {}
-        with urllib.request.urlopen(file_url, **extra_args) as resource, open(file_path, 'wb') as file:
-            while True:
-                batch = resource.read(batch_size)
-                if not batch:
-                    break
-                file.write(batch)
+        sha256 = download_file(file_url, file_path,
+                               ssl_context=context,
+                               retries=self.options.download_retries,
+                               retry_delay=self.options.download_retry_delay,
+                               segments=self.options.download_segments)
 
         if not what.sha256:
             print('Sha256 for {} not set, do no verify download'.format(what.name))
-        elif what.sha256 != get_sha256(file_path):
+        elif what.sha256 != sha256:
             os.remove(file_path)
             raise StopBuild()
-
-    def install_packages(self):
-        autoskip_file = pj(self.build_dir, ".install_packages_ok")
-        if self.distname in ('fedora', 'redhat', 'centos'):
-            package_installer = 'sudo dnf install {}'
-            package_checker = 'rpm -q --quiet {}'
-        elif self.distname in ('debian', 'Ubuntu'):
-            package_installer = 'sudo apt-get install {}'
-            package_checker = 'LANG=C dpkg -s {} 2>&1 | grep Status | grep "ok installed" 1>/dev/null 2>&1'
+        elif self.archive_store:
+            self.archive_store.add(what.sha256, file_path)
+
+    def plan_download(self, what):
+        if os.path.exists(pj(self.archive_dir, what.name)):
+            return 'skip'
+        if self.archive_store and what.sha256 and self.archive_store.has(what.sha256):
+            return 'skip'
+        return 'run'
+
+    @staticmethod
+    def _rpm_installed(packages):
+        # Missing packages are reported as "package X is not installed".
+        # (Not subprocess.run, we still support python 3.4.)
+        process = subprocess.Popen(['rpm', '-q', '--queryformat', 'installed %{NAME}\\n'] + packages,
+                                   stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        output, _ = process.communicate()
+        return set(line[10:] for line in output.decode().splitlines()
+                   if line.startswith('installed '))
+
+    @staticmethod
+    def _dpkg_installed(packages):
+        # Missing packages are only reported on stderr.
+        process = subprocess.Popen(['dpkg-query', '-W', '-f', '${Package}\\t${Status}\\n'] + packages,
+                                   stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                   env=dict(os.environ, LANG='C'))
+        output, _ = process.communicate()
+        installed = set()
+        for line in output.decode().splitlines():
+            package, _, status = line.partition('\t')
+            if status.endswith('ok installed'):
+                installed.add(package)
+        return installed
+
+    def packages_list(self):
+        """The packages we need from the distribution (None if we don't
+           know them). The dependencies they provide are marked to skip."""
         mapper_name = "{host}_{target}".format(
             host=self.distname,
             target=self.platform_info)
         try:
             package_name_mapper = PACKAGE_NAME_MAPPERS[mapper_name]
         except KeyError:
-            print("SKIP : We don't know which packages we must install to compile"
-                  " a {target} {build_type} version on a {host} host.".format(
-                      target=self.platform_info,
-                      host=self.distname))
-            return
+            return None
 
-        packages_list = package_name_mapper.get('COMMON', [])
+        packages_list = list(package_name_mapper.get('COMMON', []))
         for dep in self.targetsDict.values():
             packages = package_name_mapper.get(dep.name)
             if packages:
@@ -463,21 +640,41 @@ class BuildEnv:
             packages = getattr(dep, 'extra_packages', [])
             for package in packages:
                 packages_list += package_name_mapper.get(package, [])
-        if os.path.exists(autoskip_file):
+        return sorted(set(packages_list))
+
+    def install_packages(self):
+        # The packages we know are installed, by distribution.
+        cache_file = pj(self.build_dir, ".install_packages_ok")
+        if self.distname in ('fedora', 'redhat', 'centos'):
+            package_installer = 'sudo dnf install {}'
+            package_checker = self._rpm_installed
+        elif self.distname in ('debian', 'Ubuntu'):
+            package_installer = 'sudo apt-get install {}'
+            package_checker = self._dpkg_installed
+        packages_list = self.packages_list()
+        if packages_list is None:
+            print("SKIP : We don't know which packages we must install to compile"
+                  " a {target} version on a {host} host.".format(
+                      target=self.platform_info,
+                      host=self.distname))
+            return
+
+        known_installed = set()
+        try:
+            with open(cache_file, 'r') as f:
+                known_installed = set(json.load(f).get(self.distname, []))
+        except (OSError, ValueError):
+            # No cache (or the empty file of the old versions).
+            pass
+        packages_to_check = [p for p in packages_list if p not in known_installed]
+        if not packages_to_check:
             print("SKIP")
             return
 
-        packages_to_install = []
-        for package in packages_list:
-            print(" - {} : ".format(package), end="")
-            command = package_checker.format(package)
-            try:
-                subprocess.check_call(command, shell=True)
-            except subprocess.CalledProcessError:
-                print("NEEDED")
-                packages_to_install.append(package)
-            else:
-                print("SKIP")
+        installed = package_checker(packages_to_check)
+        packages_to_install = [p for p in packages_to_check if p not in installed]
+        for package in packages_to_check:
+            print(" - {} : {}".format(package, "NEEDED" if package in packages_to_install else "SKIP"))
 
         if packages_to_install:
             command = package_installer.format(" ".join(packages_to_install))
@@ -486,8 +683,8 @@ class BuildEnv:
         else:
             print("SKIP, No package to install.")
 
-        with open(autoskip_file, 'w'):
-            pass
+        with open(cache_file, 'w') as f:
+            json.dump({self.distname: sorted(known_installed | set(packages_to_check))}, f)
 
 class _MetaToolchain(type):
     def __new__(cls, name, bases, dct):
@@ -497,10 +694,11 @@ class _MetaToolchain(type):
         return _class
 
 
-class Toolchain(metaclass=_MetaToolchain):
+class Toolchain(Target, metaclass=_MetaToolchain):
     all_toolchains = {}
     configure_option = ""
     cmake_option = ""
+    force_native_build = True
     Builder = None
     Source = None
 
@@ -520,35 +718,15 @@ class Toolchain(metaclass=_MetaToolchain):
         return pj(self.buildEnv.source_dir, self.source.source_dir)
 
     @property
-    def _log_dir(self):
-        return self.buildEnv.log_dir
+    def compilers(self):
+        """The compilers, run through the compiler launcher (ccache, ...)."""
+        launcher = [self.buildEnv.compiler_launcher] if self.buildEnv.compiler_launcher else []
+        binaries = self.binaries
+        return {k: launcher + [binaries[k]] for k in ('CC', 'CXX')}
 
     def set_env(self, env):
         pass
 
-    def command(self, name, function, *args):
-        print("  {} {} : ".format(name, self.name), end="", flush=True)
-        log = pj(self._log_dir, 'cmd_{}_{}.log'.format(name, self.name))
-        context = Context(name, log, True)
-        try:
-            ret = function(*args, context=context)
-            context._finalise()
-            print("OK")
-            return ret
-        except SkipCommand:
-            print("SKIP")
-        except subprocess.CalledProcessError:
-            print("ERROR")
-            try:
-                with open(log, 'r') as f:
-                    print(f.read())
-            except:
-                pass
-            raise StopBuild()
-        except:
-            print("ERROR")
-            raise
-
 
 class mingw32_toolchain(Toolchain):
     name = 'mingw32'
@@ -560,7 +738,7 @@ class mingw32_toolchain(Toolchain):
 
     @property
     def binaries(self):
-        return {k:which('{}-{}'.format(self.arch_full, v))
+        return {k:which('{}-{}'.format(self.arch_full, v)) or '{}-{}'.format(self.arch_full, v)
                 for k, v in (('CC', 'gcc'),
                              ('CXX', 'g++'),
                              ('AR', 'ar'),
@@ -579,6 +757,8 @@ class mingw32_toolchain(Toolchain):
     def set_env(self, env):
         for k, v in self.binaries.items():
             env[k] = v
+        for k, v in self.compilers.items():
+            env[k] = " ".join(v)
 
         env['PKG_CONFIG_LIBDIR'] = pj(self.root_path, 'lib', 'pkgconfig')
         env['CFLAGS'] = " -O2 -g -pipe -Wall -Wp,-D_FORTIFY_SOURCE=2 -fexceptions --param=ssp-buffer-size=4 "+env['CFLAGS']
@@ -690,16 +870,20 @@ class android_ndk(Toolchain):
                     current_permissions = stat.S_IMODE(os.lstat(file_path).st_mode)
                     os.chmod(file_path, current_permissions | stat.S_IXUSR)
 
+        @property
+        def build_steps(self):
+            return ['build_platform', 'fix_permission_right']
+
         def build(self):
-            self.command('build_platform', self._build_platform)
-            self.command('fix_permission_right', self._fix_permission_right)
+            for name in self.build_steps:
+                self.command(name, getattr(self, '_'+name))
 
     def get_bin_dir(self):
         return [pj(self.builder.install_path, 'bin')]
 
     def set_env(self, env):
-        env['CC'] = self.binaries['CC']
-        env['CXX'] = self.binaries['CXX']
+        for k, v in self.compilers.items():
+            env[k] = " ".join(v)
 
         env['PKG_CONFIG_LIBDIR'] = pj(self.root_path, 'lib', 'pkgconfig')
         env['CFLAGS'] = '-fPIC -D_LARGEFILE64_SOURCE=1 -D_FILE_OFFSET_BITS=64 --sysroot={} '.format(self.root_path) + env['CFLAGS']
@@ -713,19 +897,21 @@ class android_ndk(Toolchain):
         env['NDK_DEBUG'] = '0'
 
 
-class Builder:
-    def __init__(self, options):
+class PlatformBuilder:
+    """The targets to build for one target platform."""
+    def __init__(self, options, target_platform, jobserver):
         self.options = options
+        self.target_platform = target_platform
         self.targets = OrderedDict()
-        self.buildEnv = buildEnv = BuildEnv(options, self.targets)
+        self.buildEnv = BuildEnv(options, target_platform, self.targets, jobserver)
 
         _targets = {}
         targetDef = options.targets
         self.add_targets(targetDef, _targets)
-        dependencies = self.order_dependencies(_targets, targetDef)
-        dependencies = list(remove_duplicates(dependencies))
+        graph = DependencyGraph(OrderedDict((name, target.dependencies)
+                                            for name, target in _targets.items()))
 
-        for dep in dependencies:
+        for dep in graph.topological_order(targetDef):
             if self.options.build_deps_only and dep == targetDef:
                 continue
             self.targets[dep] = _targets[dep]
@@ -739,50 +925,234 @@ class Builder:
         for dep in target.dependencies:
             self.add_targets(dep, targets)
 
-    def order_dependencies(self, _targets, targetName):
-        target = _targets[targetName]
-        for depName in target.dependencies:
-            yield from self.order_dependencies(_targets, depName)
-        yield targetName
+    def dependency_graph(self):
+        """The graph of the targets to build, in build order."""
+        return DependencyGraph(OrderedDict((depName, dep.dependencies)
+                                           for depName, dep in self.targets.items()))
 
-    def prepare_sources(self):
-        if self.options.skip_source_prepare:
-            print("SKIP")
-            return
+    def _prepare_source(self, source):
+        print_status("{}prepare sources {} :".format(self.buildEnv.status_tag, source.name))
+        source.prepare()
 
-        toolchain_sources = (tlc.source for tlc in self.buildEnv.toolchains if tlc.source)
-        for toolchain_source in toolchain_sources:
-            print("prepare sources for toolchain {} :".format(toolchain_source.name))
-            toolchain_source.prepare()
-
-        sources = (dep.source for dep in self.targets.values() if not dep.skip)
-        sources = remove_duplicates(sources, lambda s: s.__class__)
-        for source in sources:
-            print("prepare sources {} :".format(source.name))
-            source.prepare()
-
-    def build(self):
-        toolchain_builders = (tlc.builder for tlc in self.buildEnv.toolchains if tlc.builder)
-        for toolchain_builder in toolchain_builders:
-            print("build toolchain {} :".format(toolchain_builder.name))
-            toolchain_builder.build()
-
-        builders = (dep.builder for dep in self.targets.values() if (dep.builder and not dep.skip))
-        for builder in builders:
-            print("build {} :".format(builder.name))
+    def _build(self, builder):
+        print_status("{}build {} :".format(self.buildEnv.status_tag, builder.name))
+        with self.buildEnv.jobserver.slot():
             builder.build()
 
+    def add_tasks(self, scheduler):
+        """Add the tasks to prepare and build all targets to the scheduler.
+           The sources are prepared in the 'source' pool, in the background
+           of the builds, and only once for all the target platforms.
+           A dependency is built as soon as its source is prepared and its
+           dependencies are installed."""
+        prepare_sources = not self.options.skip_source_prepare
+        toolchain_keys = []
+        for tlc in self.buildEnv.toolchains:
+            source_keys = []
+            if tlc.source and prepare_sources:
+                source_keys.append(('source', tlc.source.__class__))
+                if source_keys[0] not in scheduler.tasks:
+                    scheduler.add_task(source_keys[0],
+                                       lambda source=tlc.source: self._prepare_source(source),
+                                       pool='source')
+            if tlc.builder:
+                key = ('toolchain', self.target_platform, tlc.name)
+                scheduler.add_task(key,
+                                   lambda builder=tlc.builder: self._build(builder),
+                                   source_keys)
+                toolchain_keys.append(key)
+
+        for depName, dependencies in self.dependency_graph().dependencies.items():
+            dep = self.targets[depName]
+            if dep.skip:
+                continue
+            source_key = ('source', dep.source.__class__)
+            if prepare_sources and source_key not in scheduler.tasks:
+                scheduler.add_task(source_key,
+                                   lambda source=dep.source: self._prepare_source(source),
+                                   pool='source')
+            if dep.builder:
+                scheduler.add_task(('build', self.target_platform, depName),
+                                   lambda builder=dep.builder: self._build(builder),
+                                   [source_key]
+                                   + toolchain_keys
+                                   + [('build', self.target_platform, d) for d in dependencies])
+
+    def task_targets(self, key):
+        """The names of our targets involved in a task and the stage of the task."""
+        if key[0] == 'source':
+            targets = [t for t in list(self.targets.values()) + self.buildEnv.toolchains
+                       if t.source and t.source.__class__ == key[1]]
+            return [t.name for t in targets], 'source'
+        if key[1] == self.target_platform:
+            return [key[2]], 'build'
+        return [], 'build'
+
+    def plan(self, planned_sources):
+        """What a build would do, as a list of (target name, step, action).
+           Sources in planned_sources (shared by the platforms) are skipped."""
+        self.buildEnv.packages_list()
+        plan = []
+        targets = self.buildEnv.toolchains + list(self.targets.values())
+        for target in targets:
+            if getattr(target, 'skip', False):
+                plan.append((target.name, 'system_package', 'skip'))
+                continue
+            if (target.source and not self.options.skip_source_prepare
+                and target.source.__class__ not in planned_sources):
+                planned_sources.add(target.source.__class__)
+                plan += [(target.name, step, action) for step, action in target.source.plan()]
+            if target.builder:
+                plan += [(target.name, step, action) for step, action in target.builder.plan()]
+        return plan
+
+    def sources_versions(self):
+        """The version and commit of the sources of each target."""
+        return dict((target.name, (getattr(target, 'version', None),
+                                   target.source.commit if target.source else None))
+                    for target in self.buildEnv.toolchains + list(self.targets.values()))
+
+    def step_durations(self, profile_file, cores=None):
+        with open(profile_file, 'r') as f:
+            records = json.load(f)['commands']
+        step_durations = {}
+        for record in records:
+            wall_time = record['wall_time']
+            cpu_time = record.get('user_time', 0) + record.get('system_time', 0)
+            if cores and cpu_time > wall_time:
+                # A parallel step: assume its cpu time would be spread on all cores.
+                wall_time = cpu_time / cores
+            step_key = (record['target'], record.get('stage'))
+            step_durations[step_key] = step_durations.get(step_key, 0) + wall_time
+        return step_durations
+
+
+class Builder:
+    def __init__(self, options):
+        self.options = options
+        jobserver = JobServer(options.jobs or detect_cpu_count())
+        self.platformBuilders = [PlatformBuilder(options, target_platform, jobserver)
+                                 for target_platform in options.target_platform]
+        if len(self.platformBuilders) > 1:
+            for platformBuilder in self.platformBuilders:
+                platformBuilder.buildEnv.status_tag = "[{}] ".format(platformBuilder.target_platform)
+
+    def _create_scheduler(self):
+        scheduler = Scheduler(self.options.jobs_deps)
+        scheduler.add_pool('source', self.options.jobs_sources)
+        for platformBuilder in self.platformBuilders:
+            platformBuilder.add_tasks(scheduler)
+        return scheduler
+
+    def _task_name(self, key):
+        for platformBuilder in self.platformBuilders:
+            targetNames, _ = platformBuilder.task_targets(key)
+            if targetNames:
+                break
+        if key[0] == 'source':
+            return "source {}".format(targetNames[0] if targetNames else "")
+        return "{} {}".format(key[0], " ".join(key[1:]))
+
+    def critical_path_report(self):
+        scheduler = self._create_scheduler()
+        tasks = OrderedDict((key, (deps, pool))
+                            for key, (_, deps, pool) in scheduler.tasks.items())
+        durations = dict.fromkeys(tasks, 0)
+        for platformBuilder in self.platformBuilders:
+            profile_file = self.options.critical_path
+            if profile_file is True:
+                profile_file = pj(platformBuilder.buildEnv.log_dir, 'profile.json')
+            if not os.path.exists(profile_file):
+                sys.exit("ERROR: No profile found at {}. Run a build first.".format(profile_file))
+            step_durations = platformBuilder.step_durations(profile_file, self.options.simulate_cores)
+            for key in tasks:
+                targetNames, stage = platformBuilder.task_targets(key)
+                duration = sum(step_durations.get((t, stage), 0) for t in targetNames)
+                # Sources are prepared only once, by one of the platforms.
+                durations[key] = max(durations[key], duration)
+
+        length, path = critical_path(OrderedDict((k, d) for k, (d, _) in tasks.items()), durations)
+        print("Critical path ({:.1f}s) :".format(length))
+        for key in path:
+            print("  {:<50} {:>8.1f}s".format(self._task_name(key), durations[key]))
+        print("Simulated build time{} :".format(
+            " with {} cores".format(self.options.simulate_cores) if self.options.simulate_cores else ""))
+        for slots in self.options.simulate_slots:
+            pools = dict(scheduler.pools, default=slots)
+            print("  {:>3} dependency slots : {:>8.1f}s".format(
+                slots, simulate_schedule(tasks, durations, pools)))
+
+    def plan(self):
+        planned_sources = set()
+        total = 0
+        for platformBuilder in self.platformBuilders:
+            buildEnv = platformBuilder.buildEnv
+            durations = buildEnv.profiler.read_durations(pj(buildEnv.log_dir, 'durations.json'))
+            print("[PLAN {}]".format(platformBuilder.target_platform))
+            for targetName, step, action in platformBuilder.plan(planned_sources):
+                duration = durations.get("{} {}".format(step, targetName))
+                estimate = ""
+                if action != 'skip':
+                    estimate = "?" if duration is None else "{:.1f}s".format(duration)
+                    total += duration or 0
+                print("  {:<20} {:<22} {:<6} {:>8}".format(targetName, step, action.upper(), estimate))
+        print("Estimated time (one step at a time) : {:.0f}s".format(total))
+
+    def history_report(self):
+        history = BuildHistory(pj(self.options.working_dir, 'history.sqlite'))
+        regressions = history.regressions(threshold=self.options.history_threshold / 100,
+                                          window=self.options.history_window)
+        if not regressions:
+            print("No regression found.")
+            return
+        print("Steps slower than the median of their {} previous runs by more than {}% :".format(
+            self.options.history_window, self.options.history_threshold))
+        for platform, target, command, last, baseline in regressions:
+            print("  {:<15} {:<20} {:<20} {:>8.1f}s (was {:.1f}s, +{:.0f}%)".format(
+                platform, target, command, last, baseline, (last / baseline - 1) * 100 if baseline else 0))
+
+    def list_targets(self):
+        for platformBuilder in self.platformBuilders:
+            print("{} :".format(platformBuilder.target_platform))
+            for depName, deps in platformBuilder.dependency_graph().dependencies.items():
+                print("  {:<20} {}".format(depName, " ".join(deps)))
+
+    def print_graph(self, graph_format):
+        if graph_format == 'json':
+            print(json.dumps(OrderedDict((p.target_platform, p.dependency_graph().to_json())
+                                         for p in self.platformBuilders), indent=1))
+        else:
+            for platformBuilder in self.platformBuilders:
+                print(platformBuilder.dependency_graph().to_dot(platformBuilder.target_platform))
+
     def run(self):
+        run_start = time.time()
         try:
-            print("[INSTALL PACKAGES]")
-            self.buildEnv.install_packages()
-            self.buildEnv.finalize_setup()
-            print("[PREPARE]")
-            self.prepare_sources()
-            print("[BUILD]")
-            self.build()
+            for platformBuilder in self.platformBuilders:
+                platformBuilder.buildEnv.prepare_host()
+                print("[INSTALL PACKAGES{}]".format(
+                    " " + platformBuilder.target_platform if len(self.platformBuilders) > 1 else ""))
+                platformBuilder.buildEnv.install_packages()
+                platformBuilder.buildEnv.finalize_setup()
+            self.platformBuilders[0].buildEnv.setup_ccache()
+            print("[PREPARE AND BUILD]")
+            self._create_scheduler().run()
         except StopBuild:
             sys.exit("Stopping build due to errors")
+        finally:
+            # The log dirs of the platforms we stopped before don't exist.
+            prepared = [p for p in self.platformBuilders if p.buildEnv.host_prepared]
+            for platformBuilder in prepared:
+                buildEnv = platformBuilder.buildEnv
+                buildEnv.profiler.write_report(pj(buildEnv.log_dir, 'profile.json'))
+                buildEnv.profiler.write_durations(pj(buildEnv.log_dir, 'durations.json'))
+                buildEnv.profiler.write_trace(pj(buildEnv.log_dir, 'trace.json'))
+            if prepared:
+                history = BuildHistory(pj(self.options.working_dir, 'history.sqlite'))
+                for platformBuilder in prepared:
+                    history.add_run(run_start, platformBuilder.target_platform,
+                                    platformBuilder.buildEnv.profiler.records,
+                                    platformBuilder.sources_versions())
 
 
 def parse_args():
@@ -791,16 +1161,103 @@ def parse_args():
                         choices=Dependency.all_deps.keys())
     parser.add_argument('--working-dir', default=".")
     parser.add_argument('--libprefix', default=None)
-    parser.add_argument('--target-platform', default="native_dyn", choices=BuildEnv.target_platforms)
+    parser.add_argument('--target-platform', default=["native_dyn"], nargs='+',
+                        choices=BuildEnv.target_platforms,
+                        help=("Target platforms to build for. Sources are prepared"
+                              " once for all platforms and the builds share the"
+                              " same jobs (see --jobs and --jobs-deps)."))
     parser.add_argument('--verbose', '-v', action="store_true",
                         help=("Print all logs on stdout instead of in specific"
                               " log files per commands"))
+    parser.add_argument('--log-tail', type=int, default=100, metavar='N',
+                        help="Number of lines of the log printed when a command fails.")
+    parser.add_argument('--compress-logs', choices=list(LOG_COMPRESSIONS), default='gzip',
+                        help=("Compress the log of each command once finished"
+                              " (zstd needs the zstandard python module)."))
     parser.add_argument('--no-cert-check', action='store_true',
                         help="Skip SSL certificate verification during download")
+    parser.add_argument('--download-retries', type=int, default=3, metavar='N',
+                        help=("Number of times a failed download is retried"
+                              " (resuming from the partially downloaded file)."))
+    parser.add_argument('--download-retry-delay', type=float, default=1, metavar='SECONDS',
+                        help=("Delay before the first retry of a download, doubled"
+                              " for each of the next ones."))
+    parser.add_argument('--download-segments', type=int, default=4, metavar='N',
+                        help=("Split big archives in N ranges downloaded at"
+                              " the same time."))
+    parser.add_argument('--archive-store', default=None, metavar='DIR',
+                        help=("Share the downloaded archives between working dirs"
+                              " using a store in DIR (for example"
+                              " ~/.cache/kiwix-build/archives)."))
+    parser.add_argument('--archive-store-size', type=int, default=10240, metavar='MB',
+                        help=("Maximum size of the archive store. The least"
+                              " recently used archives are removed first."))
+    parser.add_argument('--artifact-cache', default=None, metavar='DIR',
+                        help=("Store the files installed by each dependency in DIR"
+                              " and restore them instead of building the"
+                              " dependency again if nothing defining its build"
+                              " changed (version, sources, patches, options,"
+                              " platform, dependencies)."))
+    parser.add_argument('--plan', action='store_true',
+                        help=("Do not build anything, but print what each step"
+                              " would do (RUN, SKIP or MAYBE if only known when"
+                              " run) with its duration in the previous builds."))
+    parser.add_argument('--history', action='store_true',
+                        help=("Do not build anything, but print the steps whose"
+                              " last duration regressed, according to the"
+                              " history of the builds (history.sqlite in the"
+                              " working dir)."))
+    parser.add_argument('--history-threshold', type=float, default=20, metavar='PERCENT',
+                        help="Minimum slowdown of a step to report it (--history).")
+    parser.add_argument('--history-window', type=int, default=5, metavar='N',
+                        help=("Number of previous runs whose median duration is"
+                              " the baseline of a step (--history)."))
+    parser.add_argument('--list-targets', action='store_true',
+                        help=("Do not build anything, but print the targets to"
+                              " build (in build order) with their dependencies."))
+    parser.add_argument('--graph', choices=['dot', 'json'], default=None,
+                        help=("Do not build anything, but print the dependency"
+                              " graph of the targets (in json with the reverse"
+                              " dependencies, depth and fan-in of each target)."))
+    parser.add_argument('--critical-path', nargs='?', const=True, default=None, metavar='PROFILE',
+                        help=("Do not build anything, but print the chain of steps"
+                              " bounding the build time and simulate the build"
+                              " time for different numbers of dependency slots,"
+                              " using the durations recorded in PROFILE"
+                              " (LOGS/profile.json of the last build by default)."))
+    parser.add_argument('--simulate-slots', type=int, nargs='+', default=[1, 2, 4, 8], metavar='N',
+                        help="Numbers of dependency slots to simulate (see --jobs-deps).")
+    parser.add_argument('--simulate-cores', type=int, default=None, metavar='N',
+                        help=("Number of cores to simulate. Parallel steps are"
+                              " assumed to spread their cpu time on all cores."))
+    parser.add_argument('--git-mirror-dir', default=None, metavar='DIR',
+                        help=("Keep bare mirrors of the git repositories in DIR"
+                              " (for example ~/.cache/kiwix-build/git) and"
+                              " clone using them as reference."))
+    parser.add_argument('--compiler-launcher', default='ccache', metavar='COMMAND',
+                        help=("Run all the compilers (native and cross) through"
+                              " COMMAND (ccache by default, if installed)."
+                              " Use 'none' to disable it."))
+    parser.add_argument('--ccache-dir', default=None, metavar='DIR',
+                        help="Cache directory of ccache (ccache default if not set).")
+    parser.add_argument('--ccache-max-size', default=None, metavar='SIZE',
+                        help="Maximum size of the ccache cache (for example 5G).")
     parser.add_argument('--skip-source-prepare', action='store_true',
                         help="Skip the source download part")
     parser.add_argument('--build-deps-only', action='store_true',
                         help=("Build only the dependencies of the specified targets."))
+    parser.add_argument('--jobs', '-j', type=int, default=None, metavar='N',
+                        help=("Number of compilation jobs running at the same time,"
+                              " for all the dependencies built in parallel."
+                              " Default to the number of cpus available"
+                              " (taking cgroup quota into account)."))
+    parser.add_argument('--jobs-deps', type=int, default=1, metavar='N',
+                        help=("Number of dependencies to build at the same time."
+                              " A dependency is built as soon as all its own"
+                              " dependencies are installed."))
+    parser.add_argument('--jobs-sources', type=int, default=2, metavar='N',
+                        help=("Number of sources to download and prepare at the"
+                              " same time, in the background of the builds."))
 
     return parser.parse_args()
 
@@ -808,5 +1265,29 @@ def parse_args():
 if __name__ == "__main__":
     options = parse_args()
     options.working_dir = os.path.abspath(options.working_dir)
+    if options.compress_logs == 'zstd' and zstandard is None:
+        sys.exit("ERROR: --compress-logs zstd needs the zstandard python module")
+    if options.archive_store:
+        options.archive_store = os.path.abspath(os.path.expanduser(options.archive_store))
+    if options.artifact_cache:
+        options.artifact_cache = os.path.abspath(os.path.expanduser(options.artifact_cache))
+    if options.ccache_dir:
+        options.ccache_dir = os.path.abspath(os.path.expanduser(options.ccache_dir))
+    if options.git_mirror_dir:
+        options.git_mirror_dir = os.path.abspath(os.path.expanduser(options.git_mirror_dir))
     builder = Builder(options)
-    builder.run()
+    try:
+        if options.history:
+            builder.history_report()
+        elif options.plan:
+            builder.plan()
+        elif options.list_targets:
+            builder.list_targets()
+        elif options.graph:
+            builder.print_graph(options.graph)
+        elif options.critical_path:
+            builder.critical_path_report()
+        else:
+            builder.run()
+    finally:
+        HOST_PROBES.save()
@@ -3,12 +3,42 @@
 import os, sys, stat
 import argparse
 import datetime
+import gzip
+import hashlib
+import posixpath
+import queue
+import shlex
+import shutil
+import struct
 import subprocess
 import tarfile
+import tempfile
+import threading
+import time
 import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 
 pj = os.path.join
 
+# Fixed timestamp of the archived files, so the archives only change when
+# the binaries change.
+SOURCE_DATE_EPOCH = int(os.environ.get('SOURCE_DATE_EPOCH', 0))
+ZIP_EPOCH = 315532800  # 1980-01-01, the oldest date a zip can store.
+CHUNK_SIZE = 1024*1024
+
+MANIFEST_NAME = 'MANIFEST.sha256'
+# The manifest of the last deploy, at the root of the target (paths relative
+# to the root).
+LATEST_MANIFEST_NAME = 'latest.sha256'
+
+# External compressors of the tar archives (multithreaded).
+# gz is compressed in python.
+TAR_COMPRESSORS = {
+    'xz': ['xz', '-T0', '-c'],
+    'zst': ['zstd', '-T0', '-q', '-c'],
+}
+
 FILES_TO_UPLOAD = [
     'kiwix-index',
     'kiwix-install',
@@ -31,28 +61,286 @@ class Archiver:
         for filename in os.listdir(bin_dir):
             basename, _ = os.path.splitext(filename)
             if basename in FILES_TO_UPLOAD:
-                yield pj(bin_dir, filename), pj(self.archive_basename, filename)
+                # Not dated, so the archives of unchanged binaries are identical.
+                yield pj(bin_dir, filename), pj('kiwix-tools', filename)
+
+    def build_archives(self, tar_formats, zip_):
+        """Build the tar.<format> and zip archives in one read of the files.
+           Each archive is written (and compressed) in its own thread."""
+        archives = [TarWriter(pj(self.working_directory, "{}.tar.{}".format(self.archive_basename, fmt)), fmt)
+                    for fmt in tar_formats]
+        if zip_:
+            archives.append(ZipWriter(pj(self.working_directory, "{}.zip".format(self.archive_basename))))
+        queues = [queue.Queue(maxsize=8) for _ in archives]
+        errors = []
+        threads = [threading.Thread(target=self._write_archive, args=(archive, q, errors))
+                   for archive, q in zip(archives, queues)]
+        for thread in threads:
+            thread.start()
+
+        def put(*item):
+            for q in queues:
+                q.put(item)
+        try:
+            for filename, arcname in sorted(self.files_to_upload, key=lambda f: f[1]):
+                with open(filename, 'rb') as f:
+                    st = os.fstat(f.fileno())
+                    mode = 0o755 if st.st_mode & stat.S_IXUSR else 0o644
+                    put('add_file', arcname, st.st_size, mode)
+                    remaining = st.st_size
+                    while remaining:
+                        chunk = f.read(min(CHUNK_SIZE, remaining))
+                        if not chunk:
+                            raise RuntimeError("{} has been truncated while archiving".format(filename))
+                        remaining -= len(chunk)
+                        put('write', chunk)
+                put('end_file')
+        finally:
+            put('close')
+            for thread in threads:
+                thread.join()
+        if errors:
+            raise errors[0]
+        return [archive.path for archive in archives]
+
+    @staticmethod
+    def _write_archive(archive, q, errors):
+        failed = False
+        while True:
+            command, *args = q.get()
+            if failed:
+                # Keep consuming, so the reader is never blocked.
+                if command == 'close':
+                    return
+                continue
+            try:
+                getattr(archive, command)(*args)
+            except Exception as e:
+                errors.append(e)
+                failed = True
+            if command == 'close':
+                return
+
+
+class TarWriter:
+    """Write a reproducible tar archive: the files are streamed with fixed
+       owner and mtime."""
+    def __init__(self, path, compression):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.process = None
+        if compression == 'gz':
+            self.stream = gzip.GzipFile(filename='', mode='wb', fileobj=self.file,
+                                        mtime=SOURCE_DATE_EPOCH)
+        else:
+            self.process = subprocess.Popen(TAR_COMPRESSORS[compression],
+                                            stdin=subprocess.PIPE, stdout=self.file)
+            self.stream = self.process.stdin
+        self.offset = 0
+        self.padding = 0
+
+    def _write(self, data):
+        self.stream.write(data)
+        self.offset += len(data)
+
+    def add_file(self, arcname, size, mode):
+        info = tarfile.TarInfo(arcname)
+        info.size = size
+        info.mode = mode
+        info.mtime = SOURCE_DATE_EPOCH
+        self._write(info.tobuf(tarfile.GNU_FORMAT, 'utf-8', 'surrogateescape'))
+        self.padding = -size % tarfile.BLOCKSIZE
+
+    def write(self, data):
+        self._write(data)
+
+    def end_file(self):
+        self._write(tarfile.NUL * self.padding)
+
+    def close(self):
+        try:
+            self._write(tarfile.NUL * 2 * tarfile.BLOCKSIZE)
+            self._write(tarfile.NUL * (-self.offset % tarfile.RECORDSIZE))
+        finally:
+            self.stream.close()
+            if self.process:
+                returncode = self.process.wait()
+                if returncode:
+                    raise subprocess.CalledProcessError(returncode, self.process.args)
+            self.file.close()
+
+
+class ZipWriter:
+    """Write a reproducible (deflated) zip archive.
+       The entries are streamed (their crc and sizes are in a data descriptor
+       after their data), which zipfile only supports since python 3.6.
+       Zip64 is not supported (files and archive must be smaller than 4GB)."""
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'wb')
+        year, month, day, hour, minute, second = time.gmtime(max(SOURCE_DATE_EPOCH, ZIP_EPOCH))[:6]
+        self.dos_date = (year - 1980) << 9 | month << 5 | day
+        self.dos_time = hour << 11 | minute << 5 | second // 2
+        self.entries = []
+        self.entry = None
+
+    def add_file(self, arcname, size, mode):
+        name = arcname.encode('utf-8')
+        # Bit 3: crc and sizes in the data descriptor, bit 11: utf-8 name.
+        flags = 0x808
+        self.entry = {'name': name, 'flags': flags, 'offset': self.file.tell(),
+                      'external_attr': (stat.S_IFREG | mode) << 16,
+                      'crc': 0, 'compress_size': 0, 'file_size': 0}
+        self.file.write(struct.pack('<4sHHHHHLLLHH', b'PK\x03\x04', 20, flags,
+                                    zipfile.ZIP_DEFLATED, self.dos_time, self.dos_date,
+                                    0, 0, 0, len(name), 0))
+        self.file.write(name)
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+
+    def _write_compressed(self, data):
+        self.file.write(data)
+        self.entry['compress_size'] += len(data)
+
+    def write(self, data):
+        self.entry['crc'] = zlib.crc32(data, self.entry['crc'])
+        self.entry['file_size'] += len(data)
+        self._write_compressed(self.compressor.compress(data))
+
+    def end_file(self):
+        self._write_compressed(self.compressor.flush())
+        entry = self.entry
+        if max(entry['file_size'], entry['compress_size'], self.file.tell()) >= zipfile.ZIP64_LIMIT:
+            raise ValueError("{} is too big for a zip archive without zip64".format(self.path))
+        self.file.write(struct.pack('<4sLLL', b'PK\x07\x08', entry['crc'],
+                                    entry['compress_size'], entry['file_size']))
+        self.entries.append(entry)
+
+    def close(self):
+        try:
+            directory_offset = self.file.tell()
+            for entry in self.entries:
+                self.file.write(struct.pack('<4sHHHHHHLLLHHHHHLL', b'PK\x01\x02',
+                                            3 << 8 | 20, 20, entry['flags'], zipfile.ZIP_DEFLATED,
+                                            self.dos_time, self.dos_date, entry['crc'],
+                                            entry['compress_size'], entry['file_size'],
+                                            len(entry['name']), 0, 0, 0, 0,
+                                            entry['external_attr'], entry['offset']))
+                self.file.write(entry['name'])
+            directory_size = self.file.tell() - directory_offset
+            self.file.write(struct.pack('<4sHHHHLLH', b'PK\x05\x06', 0, 0,
+                                        len(self.entries), len(self.entries),
+                                        directory_size, directory_offset, 0))
+        finally:
+            self.file.close()
+
+
+def get_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+# Manifests use the format of sha256sum, so they can be checked with
+# `sha256sum -c`.
+def parse_manifest(content):
+    manifest = {}
+    for line in content.splitlines():
+        if line.strip():
+            sha256, path = line.split(None, 1)
+            manifest[path.lstrip('*')] = sha256
+    return manifest
 
-    def build_tar(self):
-        archive_name = "{}.tar.gz".format(self.archive_basename)
-        archive_name = pj(self.working_directory, archive_name)
-        with tarfile.open(archive_name, "w:gz") as archive:
-            for filename, arcname in self.files_to_upload:
-                archive.add(filename, arcname=arcname)
-        return archive_name
 
-    def build_zip(self):
-        archive_name = "{}.zip".format(self.archive_basename)
-        archive_name = pj(self.working_directory, archive_name)
-        with zipfile.ZipFile(archive_name, "w") as archive:
-            for filename, arcname in self.files_to_upload:
-                archive.write(filename, arcname)
-        return archive_name
+def format_manifest(manifest):
+    return "".join("{}  {}\n".format(manifest[path], path) for path in sorted(manifest))
+
+
+class LocalTarget:
+    """Deploy in a local directory (a stand-in for the server)."""
+    def __init__(self, base_path):
+        self.base_path = base_path
+
+    def read(self, path):
+        try:
+            with open(pj(self.base_path, path), 'r') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def makedirs(self, paths):
+        for path in paths:
+            os.makedirs(pj(self.base_path, path), exist_ok=True)
+
+    def upload(self, local_path, path):
+        dest = pj(self.base_path, path)
+        shutil.copy2(local_path, dest + '.part')
+        os.replace(dest + '.part', dest)
+
+    def copy(self, src_path, path):
+        dest = pj(self.base_path, path)
+        shutil.copy2(pj(self.base_path, src_path), dest + '.part')
+        os.replace(dest + '.part', dest)
+
+    def checksums(self, paths):
+        return {path: get_sha256(pj(self.base_path, path)) for path in paths}
+
+
+class ScpTarget:
+    """Deploy on the server with ssh and scp."""
+    def __init__(self, options):
+        self.server = options.server
+        self.base_path = options.base_path
+        self.ssh_options = ['-i', options.ssh_private_key] if options.ssh_private_key else []
+
+    def _remote_path(self, path):
+        return posixpath.join(self.base_path, path)
+
+    def _ssh(self, command, check=True):
+        """Return the exit code and the output of command run on the server."""
+        # (Not subprocess.run, we still support python 3.4.)
+        process = subprocess.Popen(['ssh'] + self.ssh_options + [self.server, command],
+                                   stdout=subprocess.PIPE, universal_newlines=True)
+        output, _ = process.communicate()
+        if check and process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, process.args, output)
+        return process.returncode, output
+
+    def read(self, path):
+        returncode, output = self._ssh('cat {} 2>/dev/null'.format(shlex.quote(self._remote_path(path))),
+                                     check=False)
+        # A missing manifest (or a failing ssh) means everything is uploaded.
+        return output if returncode == 0 else None
+
+    def makedirs(self, paths):
+        if paths:
+            self._ssh('mkdir -p ' + ' '.join(shlex.quote(self._remote_path(p)) for p in paths))
+
+    def upload(self, local_path, path):
+        remote_path = self._remote_path(path)
+        subprocess.check_call(['scp', '-p', '-q'] + self.ssh_options
+                              + [local_path, '{}:{}.part'.format(self.server, remote_path)])
+        self._ssh('mv {0}.part {0}'.format(shlex.quote(remote_path)))
+
+    def copy(self, src_path, path):
+        remote_path = shlex.quote(self._remote_path(path))
+        self._ssh('cp -p {} {}.part && mv {}.part {}'.format(
+            shlex.quote(self._remote_path(src_path)), remote_path, remote_path, remote_path))
+
+    def checksums(self, paths):
+        _, output = self._ssh('cd {} && sha256sum -- {}'.format(
+            shlex.quote(self.base_path), ' '.join(shlex.quote(p) for p in paths)), check=False)
+        return parse_manifest(output)
 
 
 class Deployer:
     def __init__(self, options):
         self.options = options
+        if options.target_dir:
+            self.target = LocalTarget(options.target_dir)
+        else:
+            self.target = ScpTarget(options)
 
     def deploy(self, directory):
         if not os.path.isdir(directory):
@@ -64,6 +352,71 @@ class Deployer:
         )
         return subprocess.check_call(command, shell=True)
 
+    def write_manifest(self, directory):
+        paths = []
+        for root, dirs, files in os.walk(directory):
+            dirs.sort()
+            for filename in files:
+                path = os.path.relpath(pj(root, filename), directory)
+                if path != MANIFEST_NAME:
+                    paths.append(path)
+        with ThreadPoolExecutor(self.options.deploy_jobs) as executor:
+            sha256s = executor.map(lambda p: get_sha256(pj(directory, p)), paths)
+            manifest = dict(zip(paths, sha256s))
+        with open(pj(directory, MANIFEST_NAME), 'w') as f:
+            f.write(format_manifest(manifest))
+        return manifest
+
+    def deploy_incremental(self, directory):
+        """Only upload the files the target doesn't have yet. Files already
+           deployed (by an earlier run, in the manifest of the directory, or
+           by the last deploy, in the latest manifest) are kept or copied on
+           the target. The manifests are uploaded last, once the files are
+           checked."""
+        if not os.path.isdir(directory):
+            return
+        name = os.path.basename(os.path.normpath(directory))
+        manifest = self.write_manifest(directory)
+        remote_manifest = parse_manifest(self.target.read(posixpath.join(name, MANIFEST_NAME)) or "")
+        latest_manifest = parse_manifest(self.target.read(LATEST_MANIFEST_NAME) or "")
+        deployed = {sha256: path for path, sha256 in latest_manifest.items()}
+        to_copy = {}
+        to_upload = []
+        for path, sha256 in sorted(manifest.items()):
+            if remote_manifest.get(path) == sha256:
+                continue
+            if sha256 in deployed:
+                to_copy[path] = deployed[sha256]
+            else:
+                to_upload.append(path)
+        print("Uploading {} file(s), copying {} already deployed, {} unchanged".format(
+            len(to_upload), len(to_copy), len(manifest) - len(to_upload) - len(to_copy)))
+        remote_paths = {path: posixpath.join(name, path) for path in to_upload + list(to_copy)}
+        self.target.makedirs(sorted({posixpath.dirname(p) for p in remote_paths.values()} | {name}))
+
+        def upload(path):
+            if path in to_copy:
+                print("  copy {} to {}".format(to_copy[path], path))
+                self.target.copy(to_copy[path], remote_paths[path])
+            else:
+                print("  upload {}".format(path))
+                self.target.upload(pj(directory, path), remote_paths[path])
+        with ThreadPoolExecutor(self.options.deploy_jobs) as executor:
+            list(executor.map(upload, sorted(remote_paths)))
+
+        if remote_paths:
+            checksums = self.target.checksums(list(remote_paths.values()))
+            corrupted = [path for path in sorted(remote_paths)
+                         if checksums.get(remote_paths[path]) != manifest[path]]
+            if corrupted:
+                sys.exit("ERROR: checksum mismatch after upload of {}".format(", ".join(corrupted)))
+        self.target.upload(pj(directory, MANIFEST_NAME), posixpath.join(name, MANIFEST_NAME))
+        with tempfile.NamedTemporaryFile('w', suffix='.sha256') as latest:
+            latest.write(format_manifest({posixpath.join(name, path): sha256
+                                          for path, sha256 in manifest.items()}))
+            latest.flush()
+            self.target.upload(latest.name, LATEST_MANIFEST_NAME)
+
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -73,7 +426,20 @@ def parse_args():
     group.add_argument('--ssh_private_key')
     group.add_argument('--server')
     group.add_argument('--base_path')
-    parser.add_argument('--tar', action="store_true")
+    group.add_argument('--incremental', action="store_true",
+                       help=("Only upload the files which are not on the server yet"
+                             " (compared with the sha256 manifests of the last deploy),"
+                             " the others are copied on the server."))
+    group.add_argument('--target-dir',
+                       help="Deploy (incrementally) in this local directory instead of the server.")
+    group.add_argument('--deploy-jobs', type=int, default=4,
+                       help="Number of files hashed and uploaded in parallel.")
+    parser.add_argument('--tar', action="store_true",
+                        help="Generate a tar.gz archive.")
+    parser.add_argument('--tar-xz', action="store_true",
+                        help="Generate a tar.xz archive (needs xz).")
+    parser.add_argument('--tar-zst', action="store_true",
+                        help="Generate a tar.zst archive (needs zstd).")
     parser.add_argument('--zip', action="store_true")
     parser.add_argument('--verbose', '-v', action="store_true",
                         help=("Print all logs on stdout instead of in specific"
@@ -84,15 +450,22 @@ if __name__ == "__main__":
     options = parse_args()
     options.install_dir = os.path.abspath(options.install_dir)
 
+    tar_formats = [fmt for fmt, wanted in (('gz', options.tar),
+                                           ('xz', options.tar_xz),
+                                           ('zst', options.tar_zst)) if wanted]
+    for fmt in tar_formats:
+        if fmt in TAR_COMPRESSORS and not shutil.which(TAR_COMPRESSORS[fmt][0]):
+            sys.exit("ERROR: {} is needed to generate a tar.{} archive".format(TAR_COMPRESSORS[fmt][0], fmt))
+
     archiver = Archiver(options)
     archive_list = []
-    if options.tar:
-        print("Generating tar archive")
-        archive_list.append(archiver.build_tar())
-    if options.zip:
-        print("Generating zip archive")
-        archive_list.append(archiver.build_zip())
+    if tar_formats or options.zip:
+        print("Generating archives")
+        archive_list = archiver.build_archives(tar_formats, options.zip)
 
     if options.deploy:
        deployer = Deployer(options)
-       deployer.deploy(archiver.working_directory)
+       if options.incremental or options.target_dir:
+           deployer.deploy_incremental(archiver.working_directory)
+       else:
+           deployer.deploy(archiver.working_directory)
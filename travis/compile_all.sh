@@ -5,6 +5,7 @@ set -e
 BASE_DIR="BUILD_${PLATFORM}"
 NIGHTLY_ARCHIVES_DIR=${HOME}/NIGHTLY_ARCHIVES
 SSH_KEY=${TRAVIS_BUILD_DIR}/travis/travisci_builder_id_key
+ARTIFACT_CACHE_DIR=${HOME}/ARTIFACT_CACHE
 
 mkdir -p ${NIGHTLY_ARCHIVES_DIR}
 
@@ -24,9 +25,9 @@ then
     echo $TARGET
     ${TRAVIS_BUILD_DIR}/kiwix-build.py \
       --target-platform $PLATFORM \
+      --artifact-cache ${ARTIFACT_CACHE_DIR} \
       --build-deps-only \
       ${TARGET}
-    rm ${BASE_DIR}/.install_packages_ok
 
     (
       cd ${BASE_DIR}
@@ -49,8 +50,10 @@ EOF
       scp -i ${SSH_KEY} ${ARCHIVE_NAME} nightlybot@download.kiwix.org:/var/www/tmp.kiwix.org/ci/
     )
 
-    ${TRAVIS_BUILD_DIR}/kiwix-build.py --target-platform $PLATFORM ${TARGET}
-    rm ${BASE_DIR}/.install_packages_ok
+    ${TRAVIS_BUILD_DIR}/kiwix-build.py \
+      --target-platform $PLATFORM \
+      --artifact-cache ${ARTIFACT_CACHE_DIR} \
+      ${TARGET}
   done
 
   # We have build every thing. Now create archives for public deployement.
@@ -83,5 +86,6 @@ else
   fi
   ${TRAVIS_BUILD_DIR}/kiwix-build.py \
     --target-platform $PLATFORM \
+    --artifact-cache ${ARTIFACT_CACHE_DIR} \
     ${TARGET}
 fi
@@ -3,7 +3,21 @@ import hashlib
 import tarfile, zipfile
 import tempfile
 import os
-from collections import namedtuple, defaultdict
+import json
+import gzip
+import sqlite3
+import statistics
+import shutil
+import fcntl
+import functools
+import resource
+import subprocess
+import threading
+import time
+import urllib.request, urllib.error
+from collections import namedtuple, defaultdict, OrderedDict, deque
+from contextlib import contextmanager, closing
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
 pj = os.path.join
 
@@ -25,13 +39,694 @@ def remove_duplicates(iterable, key_function=None):
         yield elem
 
 
+_print_lock = threading.Lock()
+
+
+def print_status(*args, **kwargs):
+    # Commands may run in parallel, so each status line must be printed
+    # in one call to not be interleaved with the ones of other commands.
+    with _print_lock:
+        print(*args, flush=True, **kwargs)
+
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def _read_proc_io(pid):
+    io = {}
+    try:
+        with open('/proc/{}/io'.format(pid), 'r') as f:
+            for line in f:
+                key, value = line.split(':')
+                io[key] = int(value)
+    except (OSError, ValueError):
+        pass
+    return io
+
+
+def wait_process(process):
+    """Wait for a subprocess.Popen and return its return code and the
+       resources used by it (and all its children)."""
+    try:
+        # Wait for the process to end without reaping it, so its /proc entry
+        # (with the io of the children it has reaped) is still there.
+        os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+        io = _read_proc_io(process.pid)
+    except (AttributeError, OSError):
+        io = {}
+    _, status, rusage = os.wait4(process.pid, 0)
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    usage = {
+        'user_time': rusage.ru_utime,
+        'system_time': rusage.ru_stime,
+        'max_rss': rusage.ru_maxrss * 1024,
+        'read_bytes': io.get('read_bytes', rusage.ru_inblock * 512),
+        'write_bytes': io.get('write_bytes', rusage.ru_oublock * 512),
+        'read_chars': io.get('rchar', 0),
+        'write_chars': io.get('wchar', 0),
+    }
+    return process.returncode, usage
+
+
+def thread_cpu_times():
+    """User and system cpu time of the current thread (if supported)."""
+    try:
+        rusage = resource.getrusage(resource.RUSAGE_THREAD)
+    except (AttributeError, OSError, ValueError):
+        return 0, 0
+    return rusage.ru_utime, rusage.ru_stime
+
+
+class Profiler:
+    """Collect the resources used by every command of a build and write them
+       as a json report and as a trace viewable in chrome://tracing or
+       Perfetto."""
+    def __init__(self, name):
+        self.name = name
+        self.records = []
+        self._lock = threading.Lock()
+        self._threads = {}
+
+    def add(self, record):
+        with self._lock:
+            thread = self._threads.setdefault(threading.get_ident(), len(self._threads))
+            record['thread'] = thread
+            self.records.append(record)
+
+    def ccache_stats(self):
+        """Compiler cache hits and misses by target."""
+        stats = OrderedDict()
+        for record in self.records:
+            if 'ccache_hits' not in record:
+                continue
+            target_stats = stats.setdefault(record['target'], {'hits': 0, 'misses': 0})
+            target_stats['hits'] += record['ccache_hits']
+            target_stats['misses'] += record['ccache_misses']
+        return stats
+
+    def write_report(self, path):
+        with open(path, 'w') as f:
+            json.dump({'name': self.name,
+                       'commands': self.records,
+                       'ccache': self.ccache_stats()}, f, indent=1)
+
+    @staticmethod
+    def read_durations(path):
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def write_durations(self, path):
+        """Update the last duration of the commands really run (not skipped)."""
+        durations = self.read_durations(path)
+        for record in self.records:
+            if record['status'] == 'OK':
+                durations["{} {}".format(record['command'], record['target'])] = record['wall_time']
+        with open(path, 'w') as f:
+            json.dump(durations, f, indent=1, sort_keys=True)
+
+    def write_trace(self, path):
+        events = [{'name': 'process_name', 'ph': 'M', 'pid': 0,
+                   'args': {'name': self.name}}]
+        for record in self.records:
+            events.append({
+                'name': "{} {}".format(record['command'], record['target']),
+                'cat': record['status'],
+                'ph': 'X',
+                'pid': 0,
+                'tid': record['thread'],
+                'ts': int(record['start'] * 1000000),
+                'dur': int(record['wall_time'] * 1000000),
+                'args': dict((k, v) for k, v in record.items()
+                             if k not in ('start', 'thread'))
+            })
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+# Statistics logged by ccache (>= 4.0) in CCACHE_STATSLOG for each compilation.
+CCACHE_HITS = ('direct_cache_hit', 'preprocessed_cache_hit')
+CCACHE_MISSES = ('cache_miss',)
+
+
+def read_ccache_statslog(path):
+    try:
+        with open(path, 'r') as f:
+            lines = [l.strip() for l in f]
+    except FileNotFoundError:
+        # Old ccache, or nothing compiled.
+        return {}
+    return {'ccache_hits': sum(1 for l in lines if l in CCACHE_HITS),
+            'ccache_misses': sum(1 for l in lines if l in CCACHE_MISSES)}
+
+
+class BuildHistory:
+    """The timings and resource usage of the steps of all the builds, in a
+       sqlite database."""
+    USAGE_KEYS = ('user_time', 'system_time', 'max_rss', 'read_bytes',
+                  'write_bytes', 'ccache_hits', 'ccache_misses')
+
+    def __init__(self, path):
+        self.path = path
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path)
+        connection.execute("""CREATE TABLE IF NOT EXISTS steps (
+                               run_start REAL, platform TEXT, target TEXT,
+                               version TEXT, git_commit TEXT, stage TEXT,
+                               command TEXT, status TEXT, start REAL,
+                               wall_time REAL, {})""".format(
+                                   ", ".join(k+" REAL" for k in self.USAGE_KEYS)))
+        connection.execute("""CREATE INDEX IF NOT EXISTS steps_key
+                              ON steps (platform, target, command, start)""")
+        return connection
+
+    def add_run(self, run_start, platform, records, sources):
+        """Add the records of a Profiler. `sources` maps the targets to their
+           (version, commit)."""
+        columns = ('run_start', 'platform', 'target', 'version', 'git_commit',
+                   'stage', 'command', 'status', 'start', 'wall_time') + self.USAGE_KEYS
+        rows = []
+        for record in records:
+            version, commit = sources.get(record['target'], (None, None))
+            rows.append((run_start, platform, record['target'], version, commit,
+                         record['stage'], record['command'], record['status'],
+                         record['start'], record['wall_time'])
+                        + tuple(record.get(k) for k in self.USAGE_KEYS))
+        with closing(self._connect()) as connection, connection:
+            connection.executemany("INSERT INTO steps ({}) VALUES ({})".format(
+                                       ", ".join(columns), ", ".join("?"*len(columns))),
+                                   rows)
+
+    def regressions(self, threshold=0.2, window=5, min_time=1):
+        """The steps whose last duration is more than `threshold` (a ratio)
+           and `min_time` seconds longer than the median of the `window`
+           previous runs of the step (skipped runs are ignored).
+           Return a list of (platform, target, command, last, baseline)."""
+        if not os.path.exists(self.path):
+            return []
+        with closing(self._connect()) as connection:
+            rows = connection.execute("""SELECT platform, target, command, wall_time
+                                         FROM steps WHERE status = 'OK'
+                                         ORDER BY platform, target, command, start""")
+            durations = OrderedDict()
+            for platform, target, command, wall_time in rows:
+                durations.setdefault((platform, target, command), []).append(wall_time)
+        regressions = []
+        for key, times in durations.items():
+            if len(times) < 2:
+                continue
+            last = times[-1]
+            baseline = statistics.median(times[-window-1:-1])
+            if last > baseline * (1 + threshold) and last - baseline > min_time:
+                regressions.append(key + (last, baseline))
+        return regressions
+
+
 def get_sha256(path):
     sha256 = hashlib.sha256()
     with open(path, 'br') as f:
-        sha256.update(f.read())
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            sha256.update(block)
     return sha256.hexdigest()
 
 
+DOWNLOAD_BATCH_SIZE = 1024 * 64
+MIN_SEGMENT_SIZE = 1024 * 1024 * 8
+
+
+def _open_url(url, ssl_context, start=0, end=None, method=None):
+    request = urllib.request.Request(url, method=method)
+    if start or end is not None:
+        request.add_header('Range', 'bytes={}-{}'.format(start, '' if end is None else end))
+    extra_args = {'context': ssl_context} if ssl_context else {}
+    return urllib.request.urlopen(request, **extra_args)
+
+
+def _remote_info(url, ssl_context):
+    """Return the size of the remote file and if the server accepts ranges.
+       The size is None if unknown."""
+    try:
+        with _open_url(url, ssl_context, method='HEAD') as resource:
+            length = resource.headers.get('Content-Length')
+            accept_ranges = resource.headers.get('Accept-Ranges', '') == 'bytes'
+            return (int(length) if length else None), accept_ranges
+    except Exception:
+        return None, False
+
+
+def _download_range(url, part_path, start, end, ssl_context, sha256=None):
+    """Download the bytes [start, end] (end is None for "up to the end") of
+       url into part_path, resuming from what part_path already contains.
+       If sha256 is given, it is updated with the whole content of part_path."""
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    if end is not None and offset >= end - start + 1:
+        if sha256 is not None:
+            _hash_file(part_path, sha256)
+        return
+    try:
+        resource = _open_url(url, ssl_context, start+offset, end)
+    except urllib.error.HTTPError as e:
+        if e.code == 416 and offset and end is None:
+            # Nothing after offset: part_path already holds the whole file
+            # (the sha256 check of the caller tells if it is the right one).
+            if sha256 is not None:
+                _hash_file(part_path, sha256)
+            return
+        raise
+    with resource:
+        if offset and getattr(resource, 'status', 206) != 206:
+            # The server ignored our range. Restart from the beginning.
+            if start:
+                raise IOError("Server doesn't support range requests for {}".format(url))
+            offset = 0
+        length = resource.headers.get('Content-Length')
+        received = 0
+        mode = 'ab' if offset else 'wb'
+        with open(part_path, mode) as part:
+            if offset and sha256 is not None:
+                _hash_file(part_path, sha256)
+            while True:
+                batch = resource.read(DOWNLOAD_BATCH_SIZE)
+                if not batch:
+                    break
+                if sha256 is not None:
+                    sha256.update(batch)
+                part.write(batch)
+                received += len(batch)
+        if length and received < int(length):
+            raise IOError("Connection closed while downloading {}".format(url))
+
+
+def _hash_file(path, sha256):
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            sha256.update(block)
+
+
+def _with_retries(function, retries, retry_delay):
+    for attempt in range(retries+1):
+        try:
+            return function()
+        except urllib.error.HTTPError as e:
+            # Client errors will not be fixed by retrying.
+            if e.code < 500 or attempt == retries:
+                raise
+        except OSError:
+            # Network errors (URLError is an OSError)
+            if attempt == retries:
+                raise
+        time.sleep(retry_delay * 2**attempt)
+
+
+def download_file(url, file_path, ssl_context=None, retries=3, retry_delay=1, segments=1):
+    """Download url into file_path and return the sha256 of the content.
+
+       Partial downloads are kept in a `file_path.part` file and are resumed
+       with HTTP range requests on the next try. Large files are split in
+       `segments` ranges downloaded at the same time if the server supports it.
+    """
+    part_path = file_path + '.part'
+    size, accept_ranges = _remote_info(url, ssl_context)
+    if not accept_ranges or size is None:
+        segments = 1
+    else:
+        segments = max(1, min(segments, size // MIN_SEGMENT_SIZE))
+
+    if segments == 1:
+        state_path = part_path + '.segments'
+        if os.path.exists(state_path):
+            # The part of a segmented download has holes, don't resume it.
+            os.remove(part_path)
+            os.remove(state_path)
+        # With the size, a part holding the whole file is not requested again.
+        end = size - 1 if size else None
+        def _download():
+            sha256 = hashlib.sha256()
+            _download_range(url, part_path, 0, end, ssl_context, sha256)
+            return sha256
+        sha256 = _with_retries(_download, retries, retry_delay)
+        os.replace(part_path, file_path)
+        return sha256.hexdigest()
+
+    return SegmentedDownload(url, part_path, size, segments, ssl_context).run(
+        file_path, retries, retry_delay)
+
+
+class SegmentedDownload:
+    """Download ranges of url at the same time, each one written in place in
+       the (preallocated) part file.
+
+       The progress of each segment is saved in `part_path.segments`, to
+       resume them. The content is hashed while it is downloaded, as soon as
+       the beginning of the file is complete (reading back what has just been
+       written).
+    """
+    SAVE_INTERVAL = 1
+
+    def __init__(self, url, part_path, size, segments, ssl_context):
+        self.url = url
+        self.part_path = part_path
+        self.state_path = part_path + '.segments'
+        self.size = size
+        self.ssl_context = ssl_context
+        segment_size = size // segments
+        self.ranges = [(i*segment_size, (i+1)*segment_size-1) for i in range(segments)]
+        self.ranges[-1] = (self.ranges[-1][0], size-1)
+        self.done = self._load_state()
+        self.condition = threading.Condition()
+        self.last_save = time.time()
+
+    def _load_state(self):
+        try:
+            with open(self.state_path, 'r') as f:
+                state = json.load(f)
+            if (state['size'] == self.size and len(state['done']) == len(self.ranges)
+                and os.path.getsize(self.part_path) == self.size):
+                return state['done']
+        except (OSError, ValueError, KeyError):
+            pass
+        return [0] * len(self.ranges)
+
+    def _save_state(self):
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'size': self.size, 'done': self.done}, f)
+        os.replace(tmp_path, self.state_path)
+        self.last_save = time.time()
+
+    def _progress(self, index, count):
+        # Called once the data is written, so the saved state never claims
+        # more than the part file contains.
+        with self.condition:
+            self.done[index] += count
+            if time.time() - self.last_save > self.SAVE_INTERVAL:
+                self._save_state()
+            self.condition.notify_all()
+
+    def _complete_size(self):
+        """The size of the beginning of the file which is downloaded."""
+        for (start, end), done in zip(self.ranges, self.done):
+            if done < end - start + 1:
+                return start + done
+        return self.size
+
+    def _download_segment(self, index, fd):
+        start, end = self.ranges[index]
+        position = start + self.done[index]
+        if position > end:
+            return
+        with _open_url(self.url, self.ssl_context, position, end) as resource:
+            if getattr(resource, 'status', 206) != 206:
+                raise IOError("Server doesn't support range requests for {}".format(self.url))
+            while position <= end:
+                batch = resource.read(min(DOWNLOAD_BATCH_SIZE, end - position + 1))
+                if not batch:
+                    raise IOError("Connection closed while downloading {}".format(self.url))
+                os.pwrite(fd, batch, position)
+                position += len(batch)
+                self._progress(index, len(batch))
+
+    def run(self, file_path, retries, retry_delay):
+        fd = os.open(self.part_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, self.size)
+            sha256 = hashlib.sha256()
+            hashed = 0
+            with ThreadPoolExecutor(max_workers=len(self.ranges)) as executor:
+                futures = [executor.submit(_with_retries,
+                                           lambda i=i: self._download_segment(i, fd),
+                                           retries,
+                                           retry_delay)
+                           for i in range(len(self.ranges))]
+                for future in futures:
+                    future.add_done_callback(lambda _: self._notify())
+                while hashed < self.size:
+                    with self.condition:
+                        while (self._complete_size() == hashed
+                               and not any(f.done() and f.exception() for f in futures)):
+                            self.condition.wait()
+                        complete = self._complete_size()
+                    for f in futures:
+                        if f.done() and f.exception():
+                            raise f.exception()
+                    while hashed < complete:
+                        block = os.pread(fd, min(HASH_BLOCK_SIZE, complete - hashed), hashed)
+                        sha256.update(block)
+                        hashed += len(block)
+        finally:
+            os.close(fd)
+            with self.condition:
+                self._save_state()
+        os.replace(self.part_path, file_path)
+        os.remove(self.state_path)
+        return sha256.hexdigest()
+
+    def _notify(self):
+        with self.condition:
+            self.condition.notify_all()
+
+
+@contextmanager
+def file_lock(path):
+    """Lock shared with other kiwix-build processes (on the same host)."""
+    with open(path, 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+def link_or_copy(src, dst):
+    """Make dst a hardlink of src, or a reflink if it's on another device,
+       or at least a copy."""
+    tmp_dst = dst + '.tmp'
+    try:
+        os.link(src, tmp_dst)
+    except OSError:
+        with open(src, 'rb') as fsrc, open(tmp_dst, 'wb') as fdst:
+            try:
+                # FICLONE: share the extents on CoW filesystems (btrfs, xfs)
+                fcntl.ioctl(fdst.fileno(), 0x40049409, fsrc.fileno())
+            except OSError:
+                shutil.copyfileobj(fsrc, fdst, HASH_BLOCK_SIZE)
+    os.replace(tmp_dst, dst)
+
+
+class ArchiveStore:
+    """A store of downloaded archives shared between working directories.
+
+       Archives are stored by their sha256 and the least recently used ones
+       are removed when the store is bigger than max_size (in bytes).
+    """
+    def __init__(self, path, max_size=None):
+        self.path = path
+        self.max_size = max_size
+
+    def _path(self, sha256):
+        return pj(self.path, sha256[:2], sha256)
+
+    def _lock(self):
+        os.makedirs(self.path, exist_ok=True)
+        return file_lock(pj(self.path, '.lock'))
+
+    def has(self, sha256):
+        return os.path.exists(self._path(sha256))
+
+    def get(self, sha256, dest):
+        """Put the archive `sha256` at dest. Return False if not in the store."""
+        with self._lock():
+            path = self._path(sha256)
+            if not os.path.exists(path):
+                return False
+            os.utime(path)
+            link_or_copy(path, dest)
+            return True
+
+    def add(self, sha256, file_path):
+        try:
+            # Already stored: only mark it as recently used.
+            os.utime(self._path(sha256))
+            return
+        except FileNotFoundError:
+            pass
+        with self._lock():
+            path = self._path(sha256)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            link_or_copy(file_path, path)
+            os.utime(path)
+            self._evict()
+
+    def _evict(self):
+        if self.max_size is None:
+            return
+        entries = []
+        for root, _, files in os.walk(self.path):
+            for f in files:
+                if f.startswith('.'):
+                    continue
+                st = os.stat(pj(root, f))
+                entries.append((st.st_mtime, st.st_size, pj(root, f)))
+        total_size = sum(e[1] for e in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            os.remove(path)
+            total_size -= size
+
+
+def get_recipe_hash(recipe):
+    return hashlib.sha256(repr(recipe).encode()).hexdigest()
+
+
+def snapshot_dir(path):
+    """Return a dict of all the files (and symlinks) in path, relative to path,
+       with their inode, change time and size.
+       (Not the modification time: installers may keep the one of the source.)"""
+    snapshot = {}
+    for root, dirs, files in os.walk(path):
+        for name in files + [d for d in dirs if os.path.islink(pj(root, d))]:
+            file_path = pj(root, name)
+            st = os.lstat(file_path)
+            snapshot[os.path.relpath(file_path, path)] = (st.st_ino, st.st_ctime_ns, st.st_size)
+    return snapshot
+
+
+def read_install_manifest(manifest_path, install_dir):
+    """The files listed in an install manifest (meson install-log.txt or cmake
+       install_manifest.txt), relative to install_dir. None if there is none."""
+    try:
+        with open(manifest_path, 'r') as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        return None
+    files = []
+    for line in lines:
+        if not line.strip() or line.startswith('#'):
+            continue
+        path = os.path.relpath(line.strip(), install_dir)
+        if not path.startswith(os.pardir) and os.path.lexists(pj(install_dir, path)):
+            files.append(path)
+    return files
+
+
+class ArtifactCache:
+    """A cache of the files installed by dependencies.
+
+       An artifact is a tarball of the files a dependency installs, stored by
+       the hash of everything defining the dependency build (its recipe).
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def _path(self, name, recipe_hash):
+        return pj(self.path, "{}_{}.tar.gz".format(name, recipe_hash))
+
+    def has(self, name, recipe_hash):
+        return os.path.exists(self._path(name, recipe_hash))
+
+    def restore(self, name, recipe_hash, install_dir):
+        """Extract the artifact in install_dir. Return False if not cached."""
+        path = self._path(name, recipe_hash)
+        if not os.path.exists(path):
+            return False
+        extra_args = {}
+        if hasattr(tarfile, 'fully_trusted_filter'):
+            extra_args['filter'] = 'fully_trusted'
+        with tarfile.open(path) as archive:
+            archive.extractall(path=install_dir, **extra_args)
+        return True
+
+    def store(self, name, recipe_hash, install_dir, files):
+        os.makedirs(self.path, exist_ok=True)
+        path = self._path(name, recipe_hash)
+        # The cache may be shared by several working dirs: write in a
+        # temporary file of our own.
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix=os.path.basename(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file, tarfile.open(fileobj=tmp_file, mode='w:gz') as archive:
+                for f in sorted(files):
+                    archive.add(pj(install_dir, f), arcname=f, recursive=False)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except:
+            os.remove(tmp_path)
+            raise
+
+
+@functools.lru_cache(maxsize=None)
+def _which(name, path):
+    return shutil.which(name, path=path)
+
+
+def which(name):
+    """shutil.which, memoised for the current PATH."""
+    return _which(name, os.environ.get('PATH'))
+
+
+class ProbeCache:
+    """The results of the host probes (tool versions, ...), kept on disk
+       between runs.
+
+       A result is reused as long as PATH and the mtimes of the files the
+       probe depends on (tools looked up in PATH or absolute paths) are
+       unchanged. Each probe is checked only once per process.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._results = None
+        self._memo = {}
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._results is None:
+            try:
+                with open(self.path, 'r') as f:
+                    self._results = json.load(f)
+            except (OSError, ValueError):
+                self._results = {}
+        return self._results
+
+    @staticmethod
+    def _file_stamp(name):
+        path = name if os.path.isabs(name) else which(name)
+        try:
+            return [path, os.stat(path).st_mtime_ns]
+        except (TypeError, OSError):
+            return [name, None]
+
+    def get(self, name, files, probe):
+        with self._lock:
+            if name in self._memo:
+                return self._memo[name]
+            key = [os.environ.get('PATH', ''), [self._file_stamp(f) for f in files]]
+            result = self._load().get(name)
+            if result is None or result['key'] != key:
+                result = {'key': key, 'value': probe()}
+                self._results[name] = result
+                self._dirty = True
+            self._memo[name] = result['value']
+            return result['value']
+
+    def save(self):
+        if not self._dirty:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = "{}.{}".format(self.path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(self._results, f, indent=1)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            # It is only a cache.
+            pass
+        self._dirty = False
+
+
 class SkipCommand(Exception):
     pass
 
@@ -40,78 +735,442 @@ class StopBuild(Exception):
     pass
 
 
+def _read_cgroup_cpu_limit():
+    # cgroup v2
+    try:
+        with open('/sys/fs/cgroup/cpu.max', 'r') as f:
+            quota, period = f.read().split()
+        if quota != 'max':
+            return int(quota) / int(period)
+        return None
+    except (OSError, ValueError):
+        pass
+    # cgroup v1
+    try:
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us', 'r') as f:
+            quota = int(f.read())
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us', 'r') as f:
+            period = int(f.read())
+        if quota > 0:
+            return quota / period
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def detect_cpu_count():
+    """Number of cpus we can use, taking affinity and cgroup quota into account."""
+    try:
+        count = len(os.sched_getaffinity(0))
+    except AttributeError:
+        count = os.cpu_count() or 1
+    limit = _read_cgroup_cpu_limit()
+    if limit is not None:
+        count = min(count, max(1, int(limit + 0.5)))
+    return count
+
+
+class JobServer:
+    """A GNU make jobserver shared by all the commands we run.
+
+       The pipe contains `jobs` tokens. Every make (or ninja) process we
+       launch must hold a token, used as its implicit slot, and takes other
+       tokens from the pipe for its extra jobs.
+    """
+    def __init__(self, jobs):
+        self.jobs = max(1, jobs)
+        self.read_fd, self.write_fd = os.pipe()
+        os.write(self.write_fd, b'+' * self.jobs)
+
+    @property
+    def fds(self):
+        return (self.read_fd, self.write_fd)
+
+    @property
+    def makeflags(self):
+        # --jobserver-fds for make < 4.2, --jobserver-auth for make >= 4.2.
+        # Unknown options in MAKEFLAGS are ignored.
+        return "-j{jobs} --jobserver-fds={r},{w} --jobserver-auth={r},{w}".format(
+            jobs=self.jobs, r=self.read_fd, w=self.write_fd)
+
+    @contextmanager
+    def slot(self):
+        # Blocks until a token is available (the threads waiting for the
+        # implicit slot of kiwix-build would never be woken up).
+        token = os.read(self.read_fd, 1)
+        try:
+            yield
+        finally:
+            os.write(self.write_fd, token)
+
+
+class Scheduler:
+    """Run tasks as soon as all their dependencies are done.
+       Each task belongs to a pool and at most `jobs` tasks of a pool run at
+       the same time. Dependencies which are not tasks of the scheduler are
+       considered as already done."""
+    def __init__(self, jobs=1):
+        self.pools = {'default': max(1, jobs)}
+        self.tasks = OrderedDict()
+
+    def add_pool(self, name, jobs):
+        self.pools[name] = max(1, jobs)
+
+    def add_task(self, key, function, dependencies=(), pool='default'):
+        self.tasks[key] = (function, list(dependencies), pool)
+
+    def run(self):
+        pending = OrderedDict(self.tasks)
+        done = set()
+        running = {}
+        running_count = dict.fromkeys(self.pools, 0)
+        error = None
+        with ThreadPoolExecutor(max_workers=sum(self.pools.values())) as executor:
+            while pending or running:
+                if error is None:
+                    for key, (function, dependencies, pool) in list(pending.items()):
+                        if running_count[pool] >= self.pools[pool]:
+                            continue
+                        if all(d in done or d not in self.tasks for d in dependencies):
+                            del pending[key]
+                            running[executor.submit(function)] = key
+                            running_count[pool] += 1
+                if not running:
+                    if error is None:
+                        error = RuntimeError("Cannot schedule tasks {}: circular dependencies".format(
+                            ", ".join(str(k) for k in pending)))
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    key = running.pop(future)
+                    running_count[self.tasks[key][2]] -= 1
+                    exception = future.exception()
+                    if exception is not None:
+                        error = error or exception
+                    else:
+                        done.add(key)
+        if error is not None:
+            raise error
+
+
+class DependencyGraph:
+    """A graph of named nodes, given as a mapping of each node to the list
+       of its dependencies (dependencies which are not nodes are ignored)."""
+    def __init__(self, dependencies):
+        self.dependencies = OrderedDict(
+            (name, [d for d in deps if d in dependencies])
+            for name, deps in dependencies.items())
+        self._order = {}
+        self._depth = {}
+        self._reverse = None
+
+    def topological_order(self, root=None):
+        """The nodes (needed by root, or all) with each node after its
+           dependencies, visiting the dependencies in their given order."""
+        if root in self._order:
+            return self._order[root]
+        order = []
+        visited = set()
+        in_progress = set()
+        def visit(name):
+            if name in visited:
+                return
+            if name in in_progress:
+                raise RuntimeError("Dependency cycle through {}".format(name))
+            in_progress.add(name)
+            for dep in self.dependencies[name]:
+                visit(dep)
+            in_progress.remove(name)
+            visited.add(name)
+            order.append(name)
+        for name in ([root] if root is not None else self.dependencies):
+            visit(name)
+        self._order[root] = order
+        return order
+
+    def reverse_dependencies(self, name, transitive=False):
+        """The nodes depending on name (directly or not)."""
+        if self._reverse is None:
+            self._reverse = OrderedDict((n, []) for n in self.dependencies)
+            for n, deps in self.dependencies.items():
+                for d in deps:
+                    self._reverse[d].append(n)
+        if not transitive:
+            return list(self._reverse[name])
+        result = []
+        pending = list(self._reverse[name])
+        while pending:
+            n = pending.pop(0)
+            if n not in result:
+                result.append(n)
+                pending.extend(self._reverse[n])
+        return result
+
+    def depth(self, name):
+        """The length of the longest chain of dependencies of name."""
+        if name not in self._depth:
+            for n in self.topological_order(name):
+                if n not in self._depth:
+                    self._depth[n] = max((self._depth[d] + 1 for d in self.dependencies[n]),
+                                         default=0)
+        return self._depth[name]
+
+    def fan_in(self, name):
+        """The number of nodes depending directly on name."""
+        return len(self.reverse_dependencies(name))
+
+    def to_json(self):
+        return OrderedDict(
+            (name, {'dependencies': deps,
+                    'reverse_dependencies': self.reverse_dependencies(name),
+                    'depth': self.depth(name),
+                    'fan_in': self.fan_in(name)})
+            for name, deps in self.dependencies.items())
+
+    def to_dot(self, name):
+        lines = ['digraph "{}" {{'.format(name)]
+        for n, deps in self.dependencies.items():
+            lines.append('  "{}";'.format(n))
+            for d in deps:
+                lines.append('  "{}" -> "{}";'.format(n, d))
+        lines.append('}')
+        return "\n".join(lines)
+
+
+def critical_path(tasks, durations):
+    """Return the length and the list of tasks of the longest chain of
+       dependent tasks. `tasks` maps keys to their list of dependencies."""
+    finish = {}
+    previous = {}
+    def _finish(key):
+        if key not in finish:
+            deps = [d for d in tasks[key] if d in tasks]
+            start = 0
+            previous[key] = None
+            for d in deps:
+                if _finish(d) > start:
+                    start = _finish(d)
+                    previous[key] = d
+            finish[key] = start + durations.get(key, 0)
+        return finish[key]
+    if not tasks:
+        return 0, []
+    last = max(tasks, key=_finish)
+    path = []
+    while last is not None:
+        path.append(last)
+        last = previous[last]
+    return finish[path[0]], path[::-1]
+
+
+def simulate_schedule(tasks, durations, pools):
+    """Simulate the Scheduler and return the total time to run all tasks.
+       `tasks` maps keys to (dependencies, pool), in the scheduler order.
+       `pools` gives the number of slots of each pool."""
+    pending = OrderedDict(tasks)
+    done = set()
+    running = []
+    now = 0
+    while pending or running:
+        for key, (dependencies, pool) in list(pending.items()):
+            if sum(1 for _, k in running if tasks[k][1] == pool) >= pools[pool]:
+                continue
+            if all(d in done or d not in tasks for d in dependencies):
+                del pending[key]
+                running.append((now + durations.get(key, 0), key))
+        if not running:
+            raise RuntimeError("Cannot simulate tasks: circular dependencies")
+        running.sort()
+        now, key = running.pop(0)
+        done.add(key)
+    return now
+
+
 class Remotefile(namedtuple('Remotefile', ('name', 'sha256', 'url'))):
     def __new__(cls, name, sha256, url=None):
         return super().__new__(cls, name, sha256, url)
 
 
 class Context:
-    def __init__(self, command_name, log_file, force_native_build):
+    def __init__(self, command_name, log_file, force_native_build, fingerprint=None):
         self.command_name = command_name
         self.log_file = log_file
         self.force_native_build = force_native_build
+        self.fingerprint = fingerprint
         self.autoskip_file = None
+        # Set once a command has written the log: the next ones append to it.
+        self.log_started = False
+        self.usage = Defaultdict(int)
+        # Extra information about how the command was run, printed with its status.
+        self.note = None
+
+    def add_usage(self, usage):
+        for key, value in usage.items():
+            if key == 'max_rss':
+                self.usage[key] = max(self.usage[key], value)
+            else:
+                self.usage[key] += value
 
     def try_skip(self, path):
+        """Skip the command if it has already been run with the same inputs.
+           The fingerprint of the inputs is stored in the autoskip file."""
         self.autoskip_file = pj(path, ".{}_ok".format(self.command_name))
         if os.path.exists(self.autoskip_file):
-            raise SkipCommand()
+            with open(self.autoskip_file, 'r') as f:
+                if f.read() == (self.fingerprint or ''):
+                    raise SkipCommand()
 
     def _finalise(self):
         if self.autoskip_file is not None:
-            with open(self.autoskip_file, 'w'):
-                pass
+            with open(self.autoskip_file, 'w') as f:
+                f.write(self.fingerprint or '')
+
+
+def tail_file(path, count):
+    """The last `count` lines of a file, without reading it all in memory."""
+    with open(path, 'r', errors='replace') as f:
+        return list(deque(f, maxlen=count))
+
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+LOG_COMPRESSIONS = {'gzip': '.gz', 'zstd': '.zst', 'none': ''}
+
+
+def compressed_log_path(path, compression):
+    return path + LOG_COMPRESSIONS[compression]
+
+
+def compress_log(path, compression):
+    """Replace path by path.gz (or path.zst)."""
+    if compression == 'none' or not os.path.exists(path):
+        return
+    dest_path = compressed_log_path(path, compression)
+    if compression == 'zstd':
+        with open(path, 'rb') as source, open(dest_path, 'wb') as dest:
+            zstandard.ZstdCompressor().copy_stream(source, dest)
+    else:
+        with open(path, 'rb') as source, gzip.open(dest_path, 'wb', compresslevel=6) as dest:
+            shutil.copyfileobj(source, dest)
+    os.remove(path)
+
+
+def plan_marker(path, command_name, fingerprint):
+    """'skip' if the command would be skipped by Context.try_skip(path),
+       'run' otherwise."""
+    try:
+        with open(pj(path, ".{}_ok".format(command_name)), 'r') as f:
+            if f.read() == (fingerprint or ''):
+                return 'skip'
+    except OSError:
+        pass
+    return 'run'
+
+
+def _extract_zip(archive_path, dest_dir, topdir):
+    with zipfile.ZipFile(archive_path) as archive:
+        members = [m for m in archive.infolist()
+                   if not topdir or m.filename.startswith(topdir+'/')]
+        archive.extractall(path=dest_dir, members=members)
+        for member in members:
+            if member.filename.endswith('/'):
+                continue
+            perm = (member.external_attr >> 16) & 0x1FF
+            os.chmod(pj(dest_dir, member.filename), perm)
+    return [m.filename for m in members]
+
+
+# Multithreaded decompressors to use (if installed) instead of python
+# tarfile, by archive extension. Each command decompresses stdin to stdout.
+DECOMPRESSORS = (
+    (('.tar.xz', '.txz'), (['pixz', '-d'], ['xz', '-T0', '-d', '-c'])),
+    (('.tar.gz', '.tgz'), (['pigz', '-d', '-c'],)),
+    (('.tar.bz2', '.tbz2', '.tbz'), (['lbzip2', '-d', '-c'], ['pbzip2', '-d', '-c'])),
+)
+
+
+def _find_decompressor(archive_path):
+    for extensions, commands in DECOMPRESSORS:
+        if archive_path.endswith(extensions):
+            for command in commands:
+                if shutil.which(command[0]):
+                    return command
+    return None
+
+
+def _extract_tar_stream(archive, dest_dir, topdir):
+    """Extract the archive in one pass, decompressing each member only once."""
+    names = []
+    directories = []
+    extra_args = {}
+    if hasattr(tarfile, 'fully_trusted_filter'):
+        extra_args['filter'] = 'fully_trusted'
+    for member in archive:
+        if topdir and not os.path.normpath(member.name).startswith(topdir+'/'):
+            continue
+        names.append(member.name)
+        if member.isdir():
+            # Permissions of directories are set at the end (as extractall
+            # does), read-only directories would prevent extracting their content.
+            directories.append(member)
+            archive.extract(member, path=dest_dir, set_attrs=False, **extra_args)
+        else:
+            archive.extract(member, path=dest_dir, **extra_args)
+    for member in reversed(directories):
+        os.chmod(pj(dest_dir, member.name), member.mode)
+    return names
+
+
+def _extract_tar(archive_path, dest_dir, topdir):
+    """Extract a tar archive and return the extracted names and the name of
+       the decompression backend used."""
+    decompressor = _find_decompressor(archive_path)
+    if decompressor is None:
+        with tarfile.open(archive_path, 'r|*') as archive:
+            return _extract_tar_stream(archive, dest_dir, topdir), 'python'
+
+    with open(archive_path, 'rb') as archive_file:
+        process = subprocess.Popen(decompressor, stdin=archive_file, stdout=subprocess.PIPE)
+    try:
+        with tarfile.open(fileobj=process.stdout, mode='r|') as archive:
+            names = _extract_tar_stream(archive, dest_dir, topdir)
+    finally:
+        process.stdout.close()
+        process.wait()
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, decompressor)
+    return names, " ".join(decompressor)
 
 
 def extract_archive(archive_path, dest_dir, topdir=None, name=None):
+    """Extract archive_path in dest_dir and return the name of the
+       decompression backend used.
+       If the archive contains only one top directory (or topdir is given),
+       only this directory is extracted, as dest_dir/name (or dest_dir/topdir)."""
     is_zip_archive = archive_path.endswith('.zip')
-    try:
+    os.makedirs(dest_dir, exist_ok=True)
+    with tempfile.TemporaryDirectory(prefix=os.path.basename(archive_path), dir=dest_dir) as tmpdir:
         if is_zip_archive:
-            archive = zipfile.ZipFile(archive_path)
-            members = archive.infolist()
-            getname = lambda info : info.filename
-            isdir = lambda info: info.filename.endswith('/')
+            names, backend = _extract_zip(archive_path, tmpdir, topdir), 'zipfile'
         else:
-            archive = tarfile.open(archive_path)
-            members = archive.getmembers()
-            getname = lambda info : getattr(info, 'name')
-            isdir = lambda info: info.isdir()
+            names, backend = _extract_tar(archive_path, tmpdir, topdir)
         if not topdir:
-            for d in (m for m in members if isdir(m)):
-                _name = getname(d)
-                if _name.endswith('/'):
-                    _name = _name[:-1]
-                if not os.path.dirname(_name):
-                    if topdir:
-                        # There is already a top dir.
-                        # Two topdirs in the same archive.
-                        # Extract all
-                        topdir = None
-                        break
-                    topdir = _name
+            # Find the top directory while we already extracted everything.
+            top_entries = set(os.path.normpath(n).split(os.sep)[0] for n in names)
+            top_directories = [d for d in top_entries
+                               if os.path.isdir(pj(tmpdir, d)) and not os.path.islink(pj(tmpdir, d))]
+            if len(top_directories) == 1:
+                topdir = top_directories[0]
         if topdir:
-            members_to_extract = [m for m in members if getname(m).startswith(topdir+'/')]
-            os.makedirs(dest_dir, exist_ok=True)
-            with tempfile.TemporaryDirectory(prefix=os.path.basename(archive_path), dir=dest_dir) as tmpdir:
-                if is_zip_archive:
-                    _members_to_extract = [getname(m) for m in members_to_extract]
-                else:
-                    _members_to_extract = members_to_extract
-                archive.extractall(path=tmpdir, members=_members_to_extract)
-                if is_zip_archive:
-                    for member in members_to_extract:
-                        if isdir(member):
-                            continue
-                        perm = (member.external_attr >> 16) & 0x1FF
-                        os.chmod(pj(tmpdir, getname(member)), perm)
-                name = name or topdir
-                os.rename(pj(tmpdir, topdir), pj(dest_dir, name))
+            name = name or topdir
+            os.rename(pj(tmpdir, topdir), pj(dest_dir, name))
         else:
             if name:
                 dest_dir = pj(dest_dir, name)
                 os.makedirs(dest_dir)
-            archive.extractall(path=dest_dir)
-    finally:
-        if archive is not None:
-            archive.close()
-
+            for entry in os.listdir(tmpdir):
+                os.rename(pj(tmpdir, entry), pj(dest_dir, entry))
+    return backend